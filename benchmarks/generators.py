@@ -0,0 +1,69 @@
+"""
+Synthetic price histories and forward curves for the benchmarks
+"""
+import numpy as np
+import pandas as pd
+
+# pandas frequency aliases for the history lengths benchmarked
+frequencies = {"daily": "D", "business": "B", "weekly": "W-FRI", "monthly": "MS"}
+history_years = (1, 10, 40)
+
+end = pd.Timestamp("2025-06-30")
+
+
+def _walk(n, seed, start=70.0):
+    rng = np.random.default_rng(seed)
+    return start + rng.normal(0, 1, n).cumsum()
+
+
+def history(years, freq="B", columns=1, seed=0):
+    """
+    Random walk prices ending on `end`
+    :param years: length of history
+    :param freq: key of frequencies or a pandas frequency
+    :param columns: number of series, a Series if 1
+    :return: Series or DataFrame
+    """
+    freq = frequencies.get(freq, freq)
+    index = pd.date_range(end - pd.DateOffset(years=years), end, freq=freq)
+    df = pd.DataFrame(
+        {"S{}".format(i): _walk(len(index), seed + i) for i in range(columns)}, index=index
+    )
+    return df["S0"] if columns == 1 else df
+
+
+def forward_curve(months=24, seed=0):
+    """
+    Monthly forward curve starting the month after `end`
+    """
+    index = pd.date_range(end + pd.offsets.MonthBegin(1), periods=months, freq="MS")
+    return pd.Series(_walk(months, seed), index=index)
+
+
+def contract_spreads(years, freq="B", seed=0):
+    """
+    One column per contract year (int column names, as commodutil forwards.time_spreads),
+    each priced from January to November of its year, for reindex_year_line_plot
+    """
+    freq = frequencies.get(freq, freq)
+    cols = {}
+    for year in range(end.year - years + 1, end.year + 1):
+        index = pd.date_range("{}-01-01".format(year), min(end, pd.Timestamp("{}-11-30".format(year))), freq=freq)
+        cols[year] = pd.Series(_walk(len(index), seed + year, start=0.0), index=index)
+    return pd.DataFrame(cols)
+
+
+def forward_history(curves=10, months=36, seed=0):
+    """
+    Forward curves (rows are contract months) as observed on each of the last `curves` business days
+    """
+    dates = pd.bdate_range(end=end, periods=curves)
+    index = pd.date_range(end + pd.offsets.MonthBegin(1), periods=months, freq="MS")
+    return pd.DataFrame({date: _walk(months, seed + i) for i, date in enumerate(dates)}, index=index)
+
+
+def table(rows=250, columns=10, seed=0):
+    """
+    Business day history with several columns, for the table benchmarks
+    """
+    return history(rows // 250 + 1, "B", columns=columns, seed=seed).tail(rows)
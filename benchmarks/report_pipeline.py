@@ -0,0 +1,99 @@
+"""
+Build 10 reports sequentially with the sync pipeline and concurrently with the async one.
+
+    python benchmarks/report_pipeline.py [--reports 10] [--charts 8] [--workers 4]
+
+Figures are rasterized to png when kaleido is installed, otherwise reports use html divs.
+Reports are also e-mailed if SMTP_HOST is set (SENDER_EMAIL/RECEIVER_EMAIL as for messaging).
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # commodplot from a checkout
+from commodplot import commodplot, jinjautils, messaging  # noqa: E402
+
+testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests")
+
+
+def load_data():
+    cl = pd.read_csv(
+        os.path.join(testdir, "test_cl.csv"),
+        index_col=0,
+        parse_dates=True,
+        dayfirst=True,
+        date_format="%Y-%m-%d",
+    )
+    return cl.dropna(how="all", axis=1)
+
+
+def report_data(cl, report, charts):
+    cols = cl.columns[-(report + charts):len(cl.columns) - report]
+    figs = {str(col): commodplot.seas_line_plot(cl[col], shaded_range=5) for col in cols}
+    return {"name": "report {}".format(report), "fig1": list(figs.values())[0], "figs": figs}
+
+
+def run_sequential(datas, png, send):
+    for data in datas:
+        conv = jinjautils.convert_dict_plotly_fig_png if png else jinjautils.convert_dict_plotly_fig_html_div
+        html = jinjautils.render_html(data, "test_report.html", package_loader_name="commodplot", plotly_image_conv_func=conv)
+        if send:
+            messaging.compose_and_send_report(data["name"], html)
+
+
+async def run_concurrent(datas, png, send):
+    async def one(data):
+        conv = jinjautils.convert_dict_plotly_fig_png_async if png else jinjautils.convert_dict_plotly_fig_html_div
+        html = await jinjautils.render_html_async(data, "test_report.html", package_loader_name="commodplot", plotly_image_conv_func=conv)
+        if send:
+            await messaging.compose_and_send_report_async(data["name"], html, smtp=smtp)
+
+    smtp = messaging.SMTPSender(connections=4) if send else None
+    try:
+        await asyncio.gather(*[one(data) for data in datas])
+    finally:
+        if smtp is not None:
+            smtp.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--reports", type=int, default=10)
+    parser.add_argument("--charts", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="renderer processes for png, 1 renders in process")
+    args = parser.parse_args()
+
+    png = importlib.util.find_spec("kaleido") is not None
+    send = bool(os.environ.get("SMTP_HOST"))
+    cl = load_data()
+    print("{} reports x {} charts, {}, {}".format(
+        args.reports, args.charts, "png" if png else "html (kaleido not installed)",
+        "sending" if send else "not sending (SMTP_HOST not set)",
+    ))
+
+    jinjautils.cpi.default_image_workers = args.workers
+    if png and args.workers > 1:  # start the renderer pool outside the timings
+        jinjautils.cpi.get_renderer_pool(workers=args.workers)._get_pool()
+
+    datas = [report_data(cl, i, args.charts) for i in range(args.reports)]
+    start = time.perf_counter()
+    run_sequential(datas, png, send)
+    sequential = time.perf_counter() - start
+
+    datas = [report_data(cl, i, args.charts) for i in range(args.reports)]
+    start = time.perf_counter()
+    asyncio.run(run_concurrent(datas, png, send))
+    concurrent = time.perf_counter() - start
+
+    print("sequential {:.2f}s, concurrent {:.2f}s ({:.1f}x)".format(
+        sequential, concurrent, sequential / concurrent
+    ))
+
+
+if __name__ == "__main__":
+    main()
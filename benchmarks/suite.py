@@ -0,0 +1,234 @@
+"""
+Time chart construction, serialization and rendering on synthetic data and save the results as json.
+
+    python benchmarks/suite.py [--output results.json] [--compare baseline.json] [--threshold 1.25]
+                               [--repeat 3] [--years 1 10 40] [--filter seas_line]
+
+Each case records the best and median time of --repeat runs and the size of the figure json
+(or html) it produces. With --compare, cases slower (or payloads larger) than the baseline by more
+than --threshold are reported as regressions and the exit code is 1. plpng is only timed when
+kaleido is installed.
+"""
+import argparse
+import datetime
+import functools
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.io as pio
+
+# run as a script from a checkout: the benchmarks directory and the repo root (for commodplot)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generators as gen  # noqa: E402
+
+from commodplot import commodplot, commodplottable, jinjautils  # noqa: E402
+
+report_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "report.html")
+
+default_output = "benchmark_results.json"
+default_repeat = 3
+default_threshold = 1.25  # flag cases this much slower than the baseline
+min_seconds = 0.005  # differences in faster cases are noise
+
+
+def payload_size(res):
+    if isinstance(res, str):
+        return len(res.encode("utf8"))
+    if isinstance(res, bytes):
+        return len(res)
+    if jinjautils.is_figure(res):
+        return len(pio.to_json(res, validate=False).encode("utf8"))
+
+
+# generated data is shared between the cases that use it, and only built for selected cases
+history = functools.lru_cache(maxsize=None)(gen.history)
+forward_curve = functools.lru_cache(maxsize=None)(gen.forward_curve)
+
+
+def cases(years=gen.history_years):
+    """
+    (name, setup) pairs to time. setup generates the case's data and returns the function
+    to time, so only the call is timed and data is only built for the cases that are run
+    """
+    for y in years:
+        for label, freq in gen.frequencies.items():
+            yield "seas_line_plot[{}y-{}]".format(y, label), lambda y=y, freq=freq: functools.partial(
+                commodplot.seas_line_plot, history(y, freq), fwd=forward_curve(), shaded_range=5, average_line=5
+            )
+            yield "line_plot[{}y-{}]".format(y, label), lambda y=y, freq=freq: functools.partial(
+                commodplot.line_plot, history(y, freq).to_frame(), fwd=forward_curve().to_frame("S0")
+            )
+
+        def seas_line_subplot(y=y):
+            fwds = pd.concat([gen.forward_curve(seed=i) for i in range(4)], axis=1)
+            return functools.partial(commodplot.seas_line_subplot, 2, 2, history(y, "B", columns=4), fwd=fwds, shaded_range=5)
+
+        yield "seas_line_subplot[{}y-business-2x2]".format(y), seas_line_subplot
+        yield "reindex_year_line_plot[{}y]".format(y), lambda y=y: functools.partial(
+            commodplot.reindex_year_line_plot, gen.contract_spreads(y), shaded_range=5
+        )
+
+        def figure(y=y):
+            return commodplot.seas_line_plot(history(y, "B"), shaded_range=5, average_line=5)
+
+        yield "plhtml[{}y-business]".format(y), lambda figure=figure: functools.partial(jinjautils.plhtml, figure())
+        yield "plhtml_binary[{}y-business]".format(y), lambda figure=figure: functools.partial(
+            jinjautils.plhtml, figure(), encoding="binary"
+        )
+        if importlib.util.find_spec("kaleido") is not None:
+            yield "plpng[{}y-business]".format(y), lambda figure=figure: functools.partial(jinjautils.plpng, figure())
+
+    forward_history = functools.lru_cache(maxsize=None)(gen.forward_history)
+    for curves in (10, 60, 250):
+        yield "forward_history_plot[{}curves]".format(curves), lambda curves=curves: functools.partial(
+            commodplot.forward_history_plot, forward_history(curves=curves)
+        )
+    yield "forward_history_plot_decimated[250curves]", lambda: functools.partial(
+        commodplot.forward_history_plot, forward_history(curves=250), decimate=True
+    )
+    yield "forward_history_plot_heatmap[250curves]", lambda: functools.partial(
+        commodplot.forward_history_plot, forward_history(curves=250), mode="heatmap"
+    )
+
+    table = functools.lru_cache(maxsize=None)(gen.table)
+    for rows in (50, 2000):
+        yield "table_plot[{}rows]".format(rows), lambda rows=rows: functools.partial(commodplot.table_plot, table(rows=rows))
+        for engine in commodplottable.table_engines:
+
+            def generate_table(rows=rows, engine=engine):
+                df = table(rows=rows)
+                return functools.partial(
+                    commodplottable.generate_table,
+                    df,
+                    precision={col: 2 for col in df.columns},
+                    accounting_col_columns=list(df.columns),
+                    engine=engine,
+                )
+
+            yield "generate_table_{}[{}rows]".format(engine, rows), generate_table
+
+    def report():
+        charts = {
+            "ch{}".format(i): commodplot.seas_line_plot(gen.history(10, "B", seed=i), shaded_range=5) for i in range(8)
+        }
+        return lambda: jinjautils.render_html({"name": "benchmark", "charts": dict(charts)}, report_template)
+
+    yield "render_html[8charts-10y]", report
+
+
+def run_case(func, repeat):
+    times = []
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "repeat": repeat,
+        "payload_bytes": payload_size(res),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def run(years=gen.history_years, repeat=default_repeat, name_filter=None):
+    """
+    Run the cases
+    :return: dict of environment info and per case results
+    """
+    results = {}
+    for name, setup in cases(years):
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            results[name] = run_case(setup(), repeat)
+        except Exception as e:  # record and carry on, so one broken chart doesn't lose the run
+            results[name] = {"error": "{}: {}".format(type(e).__name__, e)}
+        res = results[name]
+        if "error" in res:
+            print("{:45} ERROR {}".format(name, res["error"][:80]))
+        else:
+            print("{:45} {:9.4f}s {:>12}".format(name, res["min"], res["payload_bytes"] or ""))
+
+    return {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "plotly": plotly.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=default_threshold):
+    """
+    Cases slower, or with larger payloads, than the baseline by more than threshold
+    :return: list of (name, measure, baseline value, current value)
+    """
+    regressions = []
+    for name, res in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base or "error" in base:
+            continue
+        if "error" in res:
+            regressions.append((name, "error", None, res["error"]))
+            continue
+        if res["min"] > max(base["min"], min_seconds) * threshold:
+            regressions.append((name, "seconds", base["min"], res["min"]))
+        if base.get("payload_bytes") and (res.get("payload_bytes") or 0) > base["payload_bytes"] * threshold:
+            regressions.append((name, "payload_bytes", base["payload_bytes"], res["payload_bytes"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", default=default_output)
+    parser.add_argument("--compare", help="results json of a previous run")
+    parser.add_argument("--threshold", type=float, default=default_threshold)
+    parser.add_argument("--repeat", type=int, default=default_repeat)
+    parser.add_argument("--years", type=int, nargs="+", default=list(gen.history_years))
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    current = run(years=args.years, repeat=args.repeat, name_filter=args.filter)
+    with open(args.output, "w", encoding="utf8") as fh:
+        json.dump(current, fh, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as fh:
+            baseline = json.load(fh)
+        regressions = compare(baseline, current, args.threshold)
+        for name, measure, old, new in regressions:
+            print("REGRESSION {} {}: {} -> {}".format(name, measure, old, new))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {} (threshold {}x)".format(args.compare, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,12 +11,58 @@ import numpy as np
 
 from scipy.stats import zscore
 
+from commodplot import commodplotprofile as cpp
 from commodplot import commodplottrace as cptr
+from commodplot import commodplottransform as cpt
 from commodplot import commodplotutil as cpu
 
 preset_margins = {"l": 0, "r": 0, "t": 40, "b": 0}
 
 
+# forward_history_plot
+#   lines   - a line per curve snapshot
+#   heatmap - contracts by snapshot date in one heatmap trace
+#   surface - the same matrix as a 3d surface
+default_forward_history_mode = "lines"
+forward_history_modes = ("lines", "heatmap", "surface")
+
+seas_trace_sets = ["percentile_bands", "shaded_range", "average_line", "hist", "fwd"]
+
+
+def _trace_list(traces, trace_sets):
+    """
+    Flatten a dict of trace sets (from eg seas_plot_traces) into a list in draw order
+    """
+    res = []
+    for trace_set in trace_sets:
+        t = traces.get(trace_set)
+        if t:
+            res.extend(t if isinstance(t, list) else [t])
+    return res
+
+
+def seas_line_layout(**kwargs):
+    """
+    Layout settings (excluding title) shared by seasonal line plots
+    """
+    legend = go.layout.Legend(font=dict(size=10), traceorder="reversed")
+    layout_kwargs = {
+        "title_x": 0.01,
+        "xaxis_tickvals": pd.date_range(start=str(dates.curyear), periods=12, freq="MS"),
+        "xaxis_tickformat": "%b",
+        "yaxis_title": kwargs.get("yaxis_title", None),
+        "legend": legend,
+        "hovermode": kwargs.get("hovermode", "x"),
+        "margin": preset_margins,
+    }
+    template = kwargs.get("template", None)
+    if template:
+        layout_kwargs["template"] = template
+    return layout_kwargs
+
+
+@cpp.traced("chart")
+@cptr.raw_capable
 def seas_line_plot(df, fwd=None, **kwargs):
     """
     Given a DataFrame produce a seasonal line plot (x-axis - Jan-Dec, y-axis Yearly lines)
@@ -25,61 +71,142 @@ def seas_line_plot(df, fwd=None, **kwargs):
     Additional kwargs:
         template: str - Plotly template (e.g., 'plotly_white' for white background)
         line_mode: str - Line mode for traces (e.g., 'lines' for no markers)
+        seas_engine: str - Seasonalisation engine, 'commodutil' or 'native'
+        percentile_bands: list|bool - Percentile fan bands eg [10, 25, 75, 90] (True for default)
+        percentile_range: int|list - Years used for the percentile bands (default 5)
+        raw: bool - Return a plain dict figure rather than a go.Figure (see commodplottrace.figure)
     """
     df = df.sort_index()
 
-    fig = go.Figure()
     traces = cptr.seas_plot_traces(df, fwd, **kwargs)
-    if "shaded_range" in traces and traces["shaded_range"]:
-        for trace in traces["shaded_range"]:
-            fig.add_trace(trace)
 
-    if "average_line" in traces:
-        fig.add_trace(traces["average_line"])
+    title = cpu.gen_title(df, **kwargs)
+    return cptr.figure(
+        _trace_list(traces, seas_trace_sets), title=title, **seas_line_layout(**kwargs)
+    )
 
-    if "hist" in traces:
-        for trace in traces["hist"]:
-            fig.add_trace(trace)
 
-    if "fwd" in traces:
-        for trace in traces["fwd"]:
-            fig.add_trace(trace)
+def _seas_line_plot_chunk(mapping, fwd, kwargs):
+    return seas_line_plot_many(mapping, fwd=fwd, **kwargs)
 
-    fig.layout.xaxis.tickvals = pd.date_range(
-        start=str(dates.curyear), periods=12, freq="MS"
-    )
 
-    title = cpu.gen_title(df, **kwargs)
-    legend = go.layout.Legend(font=dict(size=10), traceorder="reversed")
-    yaxis_title = kwargs.get("yaxis_title", None)
-    hovermode = kwargs.get("hovermode", "x")
-    template = kwargs.get("template", None)
+@cpp.traced("chart")
+@cptr.raw_capable
+def seas_line_plot_many(mapping, fwd=None, processes=None, **kwargs):
+    """
+    Produce seasonal line plots for many series at once, returning a dict of figures.
+    Series are grouped by frequency and the layout is built once and shared. Only the native
+    seas_engine seasonalises each group together in one stacked pass (see
+    commodplottransform.seasonalise_many), other engines seasonalise the series one by one.
+    :param mapping: dict of name to series
+    :param fwd: optional dict of name to forward curve
+    :param processes: if set, split the series over a process pool of this size
+    :param kwargs: as seas_line_plot. title defaults to the name of each series
+    :return: dict of name to figure
+    """
+    fwd = fwd or {}
+    if processes and processes > 1 and len(mapping) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # child processes don't see this process's raw_figures context
+        kwargs = dict(kwargs, raw=cptr.is_raw())
+        names = list(mapping)
+        chunks = [names[i::processes] for i in range(processes)]
+        res = {}
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(
+                    _seas_line_plot_chunk,
+                    {n: mapping[n] for n in chunk},
+                    {n: fwd[n] for n in chunk if n in fwd},
+                    kwargs,
+                )
+                for chunk in chunks
+                if chunk
+            ]
+            for future in futures:
+                res.update(future.result())
+        return {n: res[n] for n in names}
+
+    series = {}
+    groups = {}
+    for name, df in mapping.items():
+        if isinstance(df, pd.DataFrame):
+            df = df[df.columns[0]]
+        series[name] = df.sort_index()
+        histfreq = kwargs.get("histfreq", None) or cpu.infer_freq(series[name])
+        groups.setdefault(histfreq, []).append(name)
+
+    layout_kwargs = seas_line_layout(**kwargs)
+    seas_engine = kwargs.get("seas_engine") or cpt.default_seasonalise_engine
+
+    figs = {}
+    for histfreq, names in groups.items():
+        if seas_engine == "native":
+            seas = cpt.seasonalise_many({n: series[n] for n in names}, histfreq=histfreq)
+        else:
+            seas = {
+                n: cpt.seasonalise(series[n], histfreq=histfreq, engine=seas_engine)
+                for n in names
+            }
 
-    layout_kwargs = {
-        "title": title,
-        "title_x": 0.01,
-        "xaxis_tickformat": "%b",
-        "yaxis_title": yaxis_title,
-        "legend": legend,
-        "hovermode": hovermode,
-        "margin": preset_margins,
-    }
-    if template:
-        layout_kwargs["template"] = template
+        for name in names:
+            chart_kwargs = dict(kwargs, histfreq=histfreq, seas=seas[name])
+            chart_kwargs.setdefault("title", name)
+            traces = cptr.seas_plot_traces(series[name], fwd.get(name), **chart_kwargs)
+            figs[name] = cptr.figure(
+                _trace_list(traces, seas_trace_sets),
+                title=cpu.gen_title(series[name], **chart_kwargs),
+                **layout_kwargs
+            )
 
-    fig.update_layout(**layout_kwargs)
+    return {n: figs[n] for n in mapping}
+
+
+def _subplot_cells(rows, cols, count):
+    """
+    (row, col) positions of the first count cells of a subplot grid, filled row by row
+    """
+    cells = [(row, col) for row in range(1, rows + 1) for col in range(1, cols + 1)]
+    return cells[:count]
 
-    return fig
 
+def _map_cells(func, items, max_workers=None):
+    """
+    Compute the traces for each subplot cell, in a thread pool if max_workers is set
+    """
+    if max_workers and max_workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
 
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, items))
+    return [func(x) for x in items]
+
+
+def _add_cell_traces(fig, cells, cell_traces, trace_sets):
+    """
+    Add the traces of every subplot cell with a single add_traces call,
+    rather than one add_trace (and one figure validation) per trace
+    """
+    data, rows, cols = [], [], []
+    for (row, col), traces in zip(cells, cell_traces):
+        for trace in _trace_list(traces, trace_sets):
+            data.append(trace)
+            rows.append(row)
+            cols.append(col)
+    if data:
+        fig.add_traces(data, rows=rows, cols=cols)
+
+
+@cpp.traced("chart")
 def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
     """
     Generate a plot with multiple seasonal subplots.
     :param rows:
     :param cols:
-    :param dfs:
-    :param fwds:
-    :param kwargs:
+    :param df: dataframe with one column per subplot
+    :param fwd: optional dataframe of forward curves, columns in the same order as df
+    :param kwargs: as seas_line_plot, plus max_workers to compute cells in a thread pool
     :return:
     """
     fig = make_subplots(
@@ -89,31 +216,21 @@ def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
         subplot_titles=kwargs.get("subplot_titles", None),
     )
 
-    chartcount = 0
-    for row in range(1, rows + 1):
-        for col in range(1, cols + 1):
-            # print(row, col)
-            if chartcount > len(df):
-                chartcount += 1
-                continue
-
-            dfx = df[df.columns[chartcount]]
-            fwdx = None
-            if fwd is not None and len(fwd) > chartcount:
-                fwdx = fwd[fwd.columns[chartcount]]
+    cells = _subplot_cells(rows, cols, len(df.columns))
 
-            showlegend = True if chartcount == 0 else False
+    def cell_traces(chartcount):
+        dfx = df[df.columns[chartcount]]
+        fwdx = None
+        if fwd is not None and len(fwd.columns) > chartcount:
+            fwdx = fwd[fwd.columns[chartcount]]
 
-            traces = cptr.seas_plot_traces(
-                dfx, fwd=fwdx, showlegend=showlegend, **kwargs
-            )
-
-            for trace_set in ["shaded_range", "hist", "fwd"]:
-                if trace_set in traces:
-                    for trace in traces[trace_set]:
-                        fig.add_trace(trace, row=row, col=col)
+        showlegend = True if chartcount == 0 else False
+        return cptr.seas_plot_traces(dfx, fwd=fwdx, showlegend=showlegend, **kwargs)
 
-            chartcount += 1
+    traces = _map_cells(cell_traces, range(len(cells)), kwargs.get("max_workers", None))
+    _add_cell_traces(
+        fig, cells, traces, ["percentile_bands", "shaded_range", "hist", "fwd"]
+    )
 
     legend = go.layout.Legend(font=dict(size=10))
     fig.update_xaxes(
@@ -131,6 +248,7 @@ def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def seas_box_plot(hist, fwd=None, **kwargs):
     hist = transforms.monthly_mean(hist)
     hist = hist.T
@@ -163,19 +281,29 @@ def seas_box_plot(hist, fwd=None, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def seas_table_plot(hist, fwd=None):
+    """
+    Table of monthly, quarterly, winter/summer and calendar averages by year (see commodplotutil.seas_table)
+    :param hist: Series, or DataFrame to show several series one after another
+    :param fwd: optional forward curve(s) continuing hist
+    :return:
+    """
     hist = hist.sort_index()
     df = cpu.seas_table(hist, fwd)
 
-    colsh = list(df.columns)
-    colsh.insert(0, "Period")
+    colsh = ["Period"] + list(df.columns)
+    if isinstance(df.index, pd.MultiIndex):  # label each series on its first row
+        series = df.index.get_level_values(0)
+        first = np.r_[True, series[1:] != series[:-1]]
+        periods = [np.where(first, series.astype(str), ""), df.index.get_level_values(1)]
+        colsh.insert(0, "")
+    else:
+        periods = [list(df.index)]
 
-    cols = [df[x] for x in df]
-    cols.insert(0, list(df.index))
-    fillcolor = ["lavender"] * 12
-    fillcolor.extend(["aquamarine"] * 4)
-    fillcolor.extend(["darkturquoise"] * 2)
-    fillcolor.append("dodgerblue")
+    cols = periods + [df[x] for x in df]
+    blocks = len(df) // len(cpu.seas_table_periods)
+    fillcolor = (["lavender"] * 12 + ["aquamarine"] * 4 + ["darkturquoise"] * 2 + ["dodgerblue"]) * blocks
 
     figm = go.Figure(
         data=[
@@ -188,32 +316,50 @@ def seas_table_plot(hist, fwd=None):
     return figm
 
 
-def table_plot(df, **kwargs):
+@cpp.traced("chart")
+@cptr.raw_capable
+def table_plot(df, page_size=None, page=0, **kwargs):
+    """
+    Plot a dataframe as a table, including the index
+    :param df:
+    :param page_size: only put this many rows in the figure, for large frames
+    :param page: which page of page_size rows to show, negative counts from the end (-1 is the last rows)
+    :param kwargs: formatted_cols (coloured red when negative, green otherwise), row_even_colour, row_odd_colour,
+        raw=True to skip plotly's validation of every cell (much faster for large tables)
+    :return:
+    """
     row_even_colour = kwargs.get("row_even_colour", "lightgrey")
     row_odd_color = kwargs.get("row_odd_colour", "white")
 
+    if page_size:
+        pages = range(0, max(len(df), 1), page_size)
+        if not -len(pages) <= page < len(pages):
+            raise ValueError(
+                "Page {} out of range, {} rows of page_size {} have pages 0 to {} (or -{} to -1)".format(
+                    page, len(df), page_size, len(pages) - 1, len(pages)
+                )
+            )
+        df = df.iloc[pages[page]:pages[page] + page_size]
+
     # include index col as part of plot
     indexname = "" if df.index.name is None else df.index.name
     colheaders = [indexname] + list(df.columns)
     headerfill = ["white" if x == "" else "grey" for x in colheaders]
 
-    cols = [df[x] for x in df.columns]
     # apply red/green to formatted_cols
     fcols = kwargs.get("formatted_cols", [])
-    font_color = [
-        ["red" if str(y).startswith("-") else "green" for y in df[x]]
-        if x in fcols
-        else "black"
-        for x in colheaders
+    font_color = ["black"] + [
+        np.where(_negative_mask(df[x]), "red", "green") if x in fcols else "black" for x in df.columns
     ]
 
-    if isinstance(df.index, pd.DatetimeIndex):  # if index is datetime, format dates
-        df.index = df.index.map(lambda x: x.strftime("%d-%m-%Y"), )
-    cols.insert(0, df.index)
+    index = df.index
+    if isinstance(index, pd.DatetimeIndex):  # if index is datetime, format dates
+        index = index.strftime("%d-%m-%Y")
+    cols = [np.asarray(index)] + [df[x].to_numpy() for x in df.columns]
 
-    fig = go.Figure(
-        data=[
-            go.Table(
+    return cptr.figure(
+        [
+            cptr.table(
                 header=dict(
                     values=colheaders,
                     fill_color=headerfill,
@@ -223,61 +369,110 @@ def table_plot(df, **kwargs):
                 cells=dict(
                     values=cols,
                     line=dict(color="#506784"),
-                    fill_color=[[row_odd_color, row_even_colour] * len(df)],
+                    fill_color=[np.where(np.arange(len(df)) % 2, row_even_colour, row_odd_color)],
                     align="right",
                     font_color=font_color,
                 ),
             )
         ]
     )
-    return fig
 
 
-def forward_history_plot(df, title=None, **kwargs):
+def _negative_mask(col):
+    # as str(value).startswith("-") per cell, from the numbers where possible
+    if pd.api.types.is_numeric_dtype(col.dtype):
+        return (col < 0).to_numpy(dtype=bool, na_value=False)
+    return col.astype(str).str.startswith("-").to_numpy()
+
+
+@cpp.traced("chart")
+def forward_history_plot(df, title=None, mode=None, **kwargs):
     """
     Given a dataframe of a curve's pricing history, plot a line chart showing how it has evolved over time
+    :param df: contracts (rows) by snapshot date (columns)
+    :param mode: 'lines' (one line per snapshot), 'heatmap' or 'surface' (all snapshots in one matrix trace),
+        see forward_history_modes, default default_forward_history_mode
+    :param decimate: thin out the snapshots, True for commodplottransform.default_snapshot_policy or a policy
+    :param max_points: downsample each curve to at most this many points (lines mode)
+    :param dayfirst: read snapshot labels like 01/02/2024 as 1 Feb (see commodplottransform.snapshot_dates)
+    :param date_format: strftime format of the snapshot labels, eg '%d/%m/%Y'
     """
-    df = df.rename(columns={x: pd.to_datetime(x) for x in df.columns})
-    df = df[sorted(list(df.columns), reverse=True)]  # have latest column first
-    df = df.rename(
-        columns={x: cpu.format_date_col(x, "%d-%b-%y") for x in df.columns}
-    )  # make nice labels for legend eg 05-Dec
+    mode = mode or default_forward_history_mode
+    if mode not in forward_history_modes:
+        raise ValueError("Unknown mode '{}', expected one of {}".format(mode, forward_history_modes))
+
+    snapshots = cpt.snapshot_dates(
+        df.columns, dayfirst=kwargs.get("dayfirst", None), format=kwargs.get("date_format", None)
+    )
+    decimate = kwargs.get("decimate", None)
+    if decimate:
+        positions = cpt.decimate_snapshots(snapshots, None if decimate is True else decimate)
+    else:
+        positions = np.arange(len(snapshots))
+    positions = positions[np.argsort(snapshots[positions], kind="stable")[::-1]]  # have latest column first
+    snapshots = snapshots[positions]
+    values = df.to_numpy(dtype=float)[:, positions]
+    names = snapshots.strftime("%d-%b-%y")  # nice labels for legend eg 05-Dec-21
+
+    yaxis_title = kwargs.get("yaxis_title", None)
+    layout = dict(
+        title=title,
+        title_x=0.01,
+        yaxis_title=yaxis_title,
+        margin=preset_margins,
+    )
+
+    if mode != "lines":
+        trace = go.Heatmap if mode == "heatmap" else go.Surface
+        fig = go.Figure(
+            trace(
+                x=df.index,
+                y=snapshots,
+                z=values.T,
+                colorscale="Aggrnyl",
+                hovertemplate="%{x|%b-%y} on %{y|%d-%b-%y}: %{z:.2f}<extra></extra>",
+            )
+        )
+        if mode == "heatmap":
+            fig.update_layout(xaxis_tickformat="%b-%y", **layout)
+        else:
+            fig.update_layout(scene=dict(xaxis_title="Contract", yaxis_title="Date", zaxis_title=yaxis_title), **layout)
+        return fig
 
     colseq = py.colors.sequential.Aggrnyl
+    if len(names) > len(colseq):  # spread the palette over all snapshots
+        colseq = py.colors.sample_colorscale(colseq, np.linspace(0, 1, len(names)))
+
     text = df.index.strftime("%b-%y")
+    max_points = kwargs.get("max_points", None)
 
     fig = go.Figure()
-    colcount = 0
-    for col in df.columns:
-        color = colseq[colcount] if colcount < len(colseq) else colseq[-1]
+    for i, name in enumerate(names):
+        y = pd.Series(values[:, i], index=df.index)
+        coltext = text
+        if max_points is not None:
+            y = cpt.downsample(y, max_points)
+            coltext = y.index.strftime("%b-%y")
         fig.add_trace(
             go.Scatter(
-                x=df.index,
-                y=df[col],
+                x=y.index,
+                y=y,
                 hoverinfo="y",
-                name=str(col),
-                line=dict(color=color),
+                name=name,
+                line=dict(color=colseq[i]),
                 hovertemplate=cptr.hovertemplate_default,
-                text=text,
+                text=coltext,
             )
         )
 
-        colcount = colcount + 1
-
-    fig["data"][0]["line"]["width"] = 2.2  # make latest line thicker
+    if len(fig.data):
+        fig["data"][0]["line"]["width"] = 2.2  # make latest line thicker
     legend = go.layout.Legend(font=dict(size=10))
-    yaxis_title = kwargs.get("yaxis_title", None)
-    fig.update_layout(
-        title=title,
-        title_x=0.01,
-        xaxis_tickformat="%b-%y",
-        yaxis_title=yaxis_title,
-        legend=legend,
-        margin=preset_margins,
-    )
+    fig.update_layout(xaxis_tickformat="%b-%y", legend=legend, **layout)
     return fig
 
 
+@cpp.traced("chart")
 def bar_line_plot(df, linecol="Total", **kwargs):
     """
     Give a dataframe, make a stacked bar chart along with overlaying line chart.
@@ -325,6 +520,7 @@ def bar_line_plot(df, linecol="Total", **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def horizontal_bar_plot(df, **kwargs):
     bar = go.Bar(x=df.iloc[:, 0], y=df.index, orientation="h")  # horizontal bars
 
@@ -342,6 +538,7 @@ def horizontal_bar_plot(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def diff_plot(df, **kwargs):
     """
     Given a dataframe, plot each column as line plot with a subplot below
@@ -382,14 +579,16 @@ def diff_plot(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
+@cptr.raw_capable
 def reindex_year_line_plot(df, **kwargs):
     """
     Given a dataframe of timeseries, reindex years and produce line plot
     :param df:
+    :param kwargs: shaded_range, percentile_bands, percentile_range, max_results, max_points, raw etc
     :return:
     """
-    fig = go.Figure()
-    dft = transforms.reindex_year(df)
+    dft = cpt.reindex_year(df)
     max_results = kwargs.get("max_results", None)
     if max_results:
         dft = dft.tail(max_results)
@@ -397,48 +596,45 @@ def reindex_year_line_plot(df, **kwargs):
 
     traces = cptr.reindex_plot_traces(dft, current_select_year=colsel, **kwargs)
 
-    if "shaded_range" in traces and traces["shaded_range"]:
-        for trace in traces["shaded_range"]:
-            fig.add_trace(trace)
-
-    if "hist" in traces:
-        for trace in traces["hist"]:
-            fig.add_trace(trace)
-
     kwargs["title_postfix"] = colsel
     title = cpu.gen_title(df[colsel], title_prefix=colsel, **kwargs)
 
     legend = go.layout.Legend(font=dict(size=10))
     yaxis_title = kwargs.get("yaxis_title", None)
-    fig.update_layout(
+    return cptr.figure(
+        _trace_list(traces, ["percentile_bands", "shaded_range", "hist"]),
         title=title,
         title_x=0.01,
         xaxis_tickformat="%b-%y",
         yaxis_title=yaxis_title,
         legend=legend,
         margin=preset_margins,
-    )
-    # zoom into last 3 years
-    fig.update_xaxes(
-        type="date",
-        range=[
+        # zoom into last 3 years
+        xaxis_type="date",
+        xaxis_range=[
             dft.tail(365 * 3).index[0].strftime("%Y-%m-%d"),
             dft.index[-1].strftime("%Y-%m-%d"),
         ],
     )
 
-    return fig
-
 
+@cpp.traced("chart")
 def candle_chart(df, **kwargs):
+    """
+    Candlestick chart of a dataframe with Open, High, Low and Close columns
+    :param df:
+    :param kwargs: title etc, max_points to aggregate into at most this many candles
+    :return:
+    """
+    candles = cpt.downsample_ohlc(df, kwargs.get("max_points", None))
     fig = go.Figure(
         data=[
             go.Candlestick(
-                x=df.index,
-                open=df["Open"],
-                high=df["High"],
-                low=df["Low"],
-                close=df["Close"],
+                x=candles.index,
+                open=candles["Open"],
+                high=candles["High"],
+                low=candles["Low"],
+                close=candles["Close"],
             )
         ]
     )
@@ -451,6 +647,7 @@ def candle_chart(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def stacked_area_chart(df, **kwargs):
     fig = go.Figure()
     group = kwargs.get("stackgroup", "stackgroup")
@@ -469,6 +666,7 @@ def stacked_area_chart(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def dataframe_to_echarts_stacked_area(df, **kwargs):
     """
     Convert a timeseries DataFrame to ECharts stacked area configuration.
@@ -594,6 +792,7 @@ def dataframe_to_echarts_stacked_area(df, **kwargs):
     return option
 
 
+@cpp.traced("chart")
 def stacked_area_chart_negative_cols(df, **kwargs):
     """
     Similar to stacked_area_chart except showing negative columns as a separate stackgroup
@@ -631,6 +830,7 @@ def stacked_area_chart_negative_cols(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def bar_chart(df, **kwargs):
     fig = go.Figure()
 
@@ -650,6 +850,7 @@ def bar_chart(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def stacked_grouped_bar_chart(df, **kwargs):
     """Given a dataframe with multi-indexed columns, generate a stacked group barchart.
     Column level 0 will be used for grouping of the bars.
@@ -732,7 +933,16 @@ def stacked_grouped_bar_chart(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
+    """
+    Generate a plot with multiple reindex year subplots, one per dataframe in dfs
+    :param rows:
+    :param cols:
+    :param dfs: list of dataframes
+    :param kwargs: as reindex_year_line_plot, plus max_workers to compute cells in a thread pool
+    :return:
+    """
     fig = make_subplots(
         cols=cols,
         rows=rows,
@@ -741,27 +951,18 @@ def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
         shared_xaxes=False,
     )
 
-    chartcount = 0
-    for row in range(1, rows + 1):
-        for col in range(1, cols + 1):
-            # print(row, col)
-            if chartcount > len(dfs):
-                chartcount += 1
-                continue
-            showlegend = True if chartcount == 0 else False
-
-            dfx = dfs[chartcount]
-            dft = transforms.reindex_year(dfx)
-            colsel = cpu.reindex_year_df_rel_col(dft)
-            traces = cptr.reindex_plot_traces(
-                dft, current_select_year=colsel, showlegend=showlegend, **kwargs
-            )
-            for trace_set in ["shaded_range", "hist"]:
-                if trace_set in traces:
-                    for trace in traces[trace_set]:
-                        fig.add_trace(trace, row=row, col=col)
+    cells = _subplot_cells(rows, cols, len(dfs))
+
+    def cell_traces(chartcount):
+        showlegend = True if chartcount == 0 else False
+        dft = cpt.reindex_year(dfs[chartcount])
+        colsel = cpu.reindex_year_df_rel_col(dft)
+        return cptr.reindex_plot_traces(
+            dft, current_select_year=colsel, showlegend=showlegend, **kwargs
+        )
 
-            chartcount += 1
+    traces = _map_cells(cell_traces, range(len(cells)), kwargs.get("max_workers", None))
+    _add_cell_traces(fig, cells, traces, ["percentile_bands", "shaded_range", "hist"])
 
     legend = go.layout.Legend(font=dict(size=10))
     yaxis_title = kwargs.get("yaxis_title", None)
@@ -782,19 +983,26 @@ def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
+@cptr.raw_capable
 def line_plot(df, fwd=None, **kwargs):
-    fig = go.Figure()
+    """
+    Line plot of each column, with forward curves as dashed lines if fwd is given
+    :param df:
+    :param fwd:
+    :param kwargs: title, yaxis_title, max_points to downsample long series, raw etc
+    :return:
+    """
     kwargs['colyearmap_enabled'] = False # dont enable colyearmap for line plot as it doesn't apply in this context
     res = cptr.line_plot_traces(df, fwd, **kwargs)
-    for trace in res:
-        fig.add_trace(trace)
 
     title = cpu.gen_title(df, inc_change_sum=False, **kwargs)
     legend = go.layout.Legend(font=dict(size=10))
     showlegend = kwargs.get("showlegend", True)
     yaxis_title = kwargs.get("yaxis_title", None)
     hovermode = kwargs.get("hovermode", "closest")
-    fig.update_layout(
+    return cptr.figure(
+        res,
         title=title,
         title_x=0.01,
         yaxis_title=yaxis_title,
@@ -803,9 +1011,9 @@ def line_plot(df, fwd=None, **kwargs):
         hovermode=hovermode,
         margin=preset_margins,
     )
-    return fig
 
 
+@cpp.traced("chart")
 def timeseries_scatter_plot(df, **kwargs):
     """
     Generate a scatter plot for a time series dataframe.
@@ -863,6 +1071,7 @@ def timeseries_scatter_plot(df, **kwargs):
     return fig
 
 
+@cpp.traced("chart")
 def timeseries_scatter_plot(df, line_last_n=None, fit_line=False, **kwargs):
     """
     Generate a scatter plot for a time series dataframe.
@@ -0,0 +1,407 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+import plotly
+import plotly.io as pio
+from plotly.utils import PlotlyJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+# figures are exported in this process unless a number of workers is given, in which case
+# they are spread over a long lived pool of worker processes which each keep their own
+# kaleido renderer (and chrome instance for kaleido>=1) alive between figures. The pool
+# starts processes, so scripts using it need an if __name__ == "__main__" guard on
+# Windows/macOS.
+default_image_workers = None
+default_image_timeout = 120  # seconds to wait for any one figure in the pool
+min_pool_figures = 2  # fewer figures than this are exported in process even with workers
+
+# on-disk cache of rendered images, see enable_image_cache
+default_image_cache_dir = os.environ.get(
+    "COMMODPLOT_IMAGE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "commodplot", "images")
+)
+default_image_cache_bytes = 512 * 1024 * 1024
+
+_warmup_figure = {"data": [{"type": "scatter", "x": [0, 1], "y": [0, 1]}], "layout": {}}
+
+
+def render_image(fig_dict, **opts):
+    """
+    Default renderer used by the pool workers: plotly/kaleido export of a figure dict
+    """
+    return pio.to_image(fig_dict, validate=False, **opts)
+
+
+def _init_worker(renderer):
+    """
+    Start the renderer once per worker process so the first real figure doesn't pay for it
+    """
+    try:
+        import kaleido
+
+        if hasattr(kaleido, "start_sync_server"):  # kaleido>=1.1 keeps chrome running
+            kaleido.start_sync_server(silence_warnings=True)
+    except Exception:
+        pass
+
+    try:
+        renderer(_warmup_figure, format="png", width=10, height=10)
+    except Exception as e:  # surface errors on the real figures instead
+        logger.debug("Image renderer warm up failed: %s", e)
+
+
+class RendererPool:
+    """
+    Long lived pool of worker processes for exporting figures to images.
+    Workers are started (and warmed up) on first use and reused until close is called.
+    """
+
+    def __init__(self, workers=None, timeout=None, renderer=render_image):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.timeout = timeout if timeout is not None else default_image_timeout
+        self.renderer = renderer
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    processes=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self.renderer,),
+                )
+                # run a no-op per worker so they all start and warm up now
+                for res in [self._pool.apply_async(int) for _ in range(self.workers)]:
+                    res.wait()
+            return self._pool
+
+    def _timed_out(self):
+        logger.error("Image export timed out after %ss, restarting workers", self.timeout)
+        self.close(kill=True)  # a stuck renderer won't finish by itself
+
+    def to_images(self, fig_dicts, format="png", width=None, height=None, scale=None):
+        """
+        Render figure dicts concurrently
+        :param fig_dicts: list of figure dicts (eg Figure.to_dict())
+        :return: list of image bytes in the same order
+        """
+        if not fig_dicts:
+            return []
+
+        opts = dict(format=format, width=width, height=height, scale=scale)
+        pool = self._get_pool()
+        results = [pool.apply_async(self.renderer, (fig,), opts) for fig in fig_dicts]
+        try:
+            return [res.get(timeout=self.timeout) for res in results]
+        except multiprocessing.TimeoutError:
+            self._timed_out()
+            raise
+
+    async def to_images_async(self, fig_dicts, format="png", width=None, height=None, scale=None):
+        """
+        Async version of to_images: awaits the worker processes without blocking the event loop
+        """
+        if not fig_dicts:
+            return []
+
+        loop = asyncio.get_running_loop()
+        opts = dict(format=format, width=width, height=height, scale=scale)
+        pool = await loop.run_in_executor(None, self._get_pool)  # first use waits for warm up
+
+        def submit(fig):
+            future = loop.create_future()
+
+            def done(res):
+                if not future.done():
+                    future.set_result(res)
+
+            def failed(exc):
+                if not future.done():
+                    future.set_exception(exc)
+
+            pool.apply_async(
+                self.renderer, (fig,), opts,
+                callback=lambda res: loop.call_soon_threadsafe(done, res),
+                error_callback=lambda exc: loop.call_soon_threadsafe(failed, exc),
+            )
+            return future
+
+        futures = [submit(fig) for fig in fig_dicts]
+        try:
+            return await asyncio.gather(*[asyncio.wait_for(f, timeout=self.timeout) for f in futures])
+        except asyncio.TimeoutError:
+            for f in futures:
+                f.cancel()
+            await loop.run_in_executor(None, self._timed_out)  # terminating the workers blocks
+            raise
+
+    def close(self, kill=False):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        if kill:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_renderer_pool(workers=None, timeout=None):
+    """
+    Process wide renderer pool, created on first use. Passing workers/timeout
+    that differ from the current pool replaces it.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and (
+            (workers is not None and workers != _pool.workers)
+            or (timeout is not None and timeout != _pool.timeout)
+        ):
+            _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = RendererPool(workers=workers, timeout=timeout)
+        return _pool
+
+
+def close_renderer_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_renderer_pool)
+
+
+class ImageCache:
+    """
+    Content addressed cache of rendered images in a directory, keyed by a hash of the
+    figure json and export options. Bounded by the total size of the files, evicting
+    the least recently used (by modification time, which is touched on every hit).
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or default_image_cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else default_image_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.nbytes = sum(os.path.getsize(f) for f in self._files())
+
+    @staticmethod
+    def key(fig_dict, format="png", width=None, height=None, scale=None):
+        # sorted so equal figures built in a different order hash the same
+        js = json.dumps(fig_dict, sort_keys=True, separators=(",", ":"), cls=PlotlyJSONEncoder)
+        h = hashlib.sha256(js.encode("utf8"))
+        opts = dict(format=format, width=width, height=height, scale=scale, plotly=plotly.__version__)
+        h.update(json.dumps(opts, sort_keys=True).encode("utf8"))
+        return "{}.{}".format(h.hexdigest(), format)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.startswith("."):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                res = fh.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return res
+
+    def put(self, key, img):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(img)
+        with self._lock:
+            try:  # overwriting a key replaces its file rather than adding to the total
+                old = os.path.getsize(path)
+            except OSError:
+                old = 0
+            os.replace(tmp, path)  # atomic so concurrent readers never see partial files
+            self.nbytes += len(img) - old
+            if self.nbytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for f in self._files():
+            try:
+                stat = os.stat(f)
+            except OSError:  # removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        files.sort()
+        self.nbytes = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            self.nbytes -= size
+
+    def clear(self):
+        with self._lock:
+            for f in list(self._files()):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            self.nbytes = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": sum(1 for _ in self._files()),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "directory": self.directory,
+        }
+
+
+_image_cache = None  # ImageCache when caching is enabled
+
+
+def enable_image_cache(directory=None, max_bytes=None):
+    """
+    Turn on the on-disk cache of rendered images used by to_image/to_images (and so plpng)
+    :param directory: default default_image_cache_dir ($COMMODPLOT_IMAGE_CACHE or ~/.cache/commodplot/images)
+    :param max_bytes: size cap of the directory, default default_image_cache_bytes
+    :return:
+    """
+    global _image_cache
+    _image_cache = ImageCache(directory=directory, max_bytes=max_bytes)
+    return _image_cache
+
+
+def disable_image_cache():
+    global _image_cache
+    _image_cache = None
+
+
+def image_cache_info():
+    """
+    Return dict of hits, misses, entries and bytes used, or None if caching is off
+    """
+    if _image_cache is not None:
+        return _image_cache.info()
+
+
+def to_image(fig_dict, format="png", width=None, height=None, scale=None):
+    """
+    Render one figure dict in this process, using the image cache if enabled
+    """
+    opts = dict(format=format, width=width, height=height, scale=scale)
+    cache = _image_cache
+    if cache is None:
+        return render_image(fig_dict, **opts)
+
+    key = cache.key(fig_dict, **opts)
+    img = cache.get(key)
+    if img is None:
+        img = render_image(fig_dict, **opts)
+        cache.put(key, img)
+    return img
+
+
+def _use_pool(fig_dicts, workers):
+    if workers is None:
+        workers = default_image_workers
+    return bool(workers) and workers > 1 and len(fig_dicts) >= min_pool_figures
+
+
+def to_images(fig_dicts, workers=None, timeout=None, **opts):
+    """
+    Render a list of figure dicts to image bytes. Figures are rendered one after another in
+    this process unless workers is given, then they are shared out over the process wide
+    renderer pool. Figures found in the image cache (if enabled) are not rendered again.
+    :param fig_dicts:
+    :param workers: number of worker processes, default default_image_workers (in process)
+    :param timeout: seconds to wait for any one figure in the pool, default default_image_timeout
+    :param opts: format, width, height, scale
+    :return: list of image bytes
+    """
+    if not _use_pool(fig_dicts, workers):
+        return [to_image(fig, **opts) for fig in fig_dicts]
+
+    cache = _image_cache
+    pool = get_renderer_pool(workers=workers, timeout=timeout)
+    if cache is None:
+        return pool.to_images(fig_dicts, **opts)
+
+    keys, res, missing = _cache_lookup(cache, fig_dicts, opts)
+    if missing:
+        images = pool.to_images([fig_dicts[i] for i in missing], **opts)
+        _cache_store(cache, keys, res, missing, images)
+    return res
+
+
+async def to_images_async(fig_dicts, workers=None, timeout=None, **opts):
+    """
+    Async version of to_images, so several reports can rasterize at the same time.
+    In process rendering runs in a thread to keep the event loop free.
+    """
+    if not _use_pool(fig_dicts, workers):
+        return await asyncio.to_thread(to_images, fig_dicts, workers=1, **opts)
+
+    cache = _image_cache
+    pool = get_renderer_pool(workers=workers, timeout=timeout)
+    if cache is None:
+        return await pool.to_images_async(fig_dicts, **opts)
+
+    keys, res, missing = await asyncio.to_thread(_cache_lookup, cache, fig_dicts, opts)
+    if missing:
+        images = await pool.to_images_async([fig_dicts[i] for i in missing], **opts)
+        await asyncio.to_thread(_cache_store, cache, keys, res, missing, images)
+    return res
+
+
+def _cache_lookup(cache, fig_dicts, opts):
+    keys = [cache.key(fig, **opts) for fig in fig_dicts]
+    res = [cache.get(key) for key in keys]
+    missing = [i for i, img in enumerate(res) if img is None]
+    return keys, res, missing
+
+
+def _cache_store(cache, keys, res, missing, images):
+    for i, img in zip(missing, images):
+        cache.put(keys[i], img)
+        res[i] = img
@@ -0,0 +1,188 @@
+import asyncio
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Opt-in timeline of where a report build spends its time (chart functions, seasonal
+# traces, figure conversion, jinja rendering, sending), written in the Chrome trace event
+# format which chrome://tracing and https://ui.perfetto.dev open.
+# Setting $COMMODPLOT_TRACE to a filename traces the whole process and writes it at exit.
+default_trace_file = os.environ.get("COMMODPLOT_TRACE")
+
+_tracer = None  # Tracer while tracing is on
+
+
+class Tracer:
+    """
+    Collects timed spans as Chrome trace 'complete' events
+    """
+
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        """
+        Seconds since tracing started
+        """
+        return time.perf_counter() - self._start
+
+    def _now(self):
+        return (time.perf_counter() - self._start) * 1e6  # trace timestamps are in microseconds
+
+    def _tid(self):
+        tid = threading.get_ident()
+        try:  # concurrent tasks on one thread would overlap, so give each task its own row
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            return id(task), task.get_name()
+        return tid, threading.current_thread().name
+
+    @contextlib.contextmanager
+    def span(self, name, cat="commodplot", **args):
+        tid, thread_name = self._tid()
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": start,
+                "dur": self._now() - start,
+                "pid": self._pid,
+                "tid": tid,
+            }
+            if args:
+                event["args"] = args
+            with self._lock:
+                if tid not in self._threads:
+                    self._threads.add(tid)
+                    self.events.append(
+                        {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": thread_name}}
+                    )
+                self.events.append(event)
+
+    def to_dict(self):
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, filename):
+        """
+        Write the timeline as Chrome trace json
+        """
+        logger.info("Writing trace to {}".format(filename))
+        with open(filename, "w", encoding="utf8") as fh:
+            json.dump(self.to_dict(), fh)
+        return filename
+
+
+def start_tracing():
+    """
+    Start recording spans, replacing any tracer already running
+    :return: Tracer
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing(filename=None):
+    """
+    Stop recording spans
+    :param filename: if provided, save the timeline to this file
+    :return: the Tracer that was running, or None
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and filename:
+        tracer.save(filename)
+    return tracer
+
+
+def get_tracer():
+    """
+    The running Tracer, or None when tracing is off
+    """
+    return _tracer
+
+
+@contextlib.contextmanager
+def tracing(filename=None):
+    """
+    Trace the enclosed block, saving the timeline to filename if given
+
+    with tracing("report.trace.json"):
+        data["ch1"] = seas_line_plot(df)
+        render_html(data, "report.html", filename="report.html")
+    """
+    tracer = start_tracing()
+    try:
+        yield tracer
+    finally:
+        if _tracer is tracer:
+            stop_tracing(filename)
+
+
+@contextlib.contextmanager
+def span(name, cat="commodplot", **args):
+    """
+    Time the enclosed block as a span if tracing is on
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, cat, **args):
+        yield
+
+
+def traced(cat="commodplot"):
+    """
+    Decorator timing each call of a function (or coroutine function) as a span if tracing is on
+    """
+
+    def decorator(func):
+        name = func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                tracer = _tracer
+                if tracer is None:
+                    return await func(*args, **kwargs)
+                with tracer.span(name, cat):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if default_trace_file:
+    start_tracing()
+    atexit.register(lambda: stop_tracing(default_trace_file))
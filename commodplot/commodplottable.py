@@ -1,6 +1,17 @@
+import json
+import uuid
+
+import numpy as np
 import pandas as pd
 import typing as t
 
+# how generate_table writes the table
+#   styler - pandas Styler, one css rule per coloured cell
+#   html   - columns formatted with numpy and written straight to html, accounting colours
+#            taken from the numbers before formatting. Much faster for large frames
+default_table_engine = "styler"
+table_engines = ("styler", "html")
+
 table_style = [
     dict(selector="tr:hover", props=[("background", "#D6EEEE")]),
     dict(
@@ -66,16 +77,136 @@ def color_accounting(val):
     return "color: %s" % color
 
 
+def table_css(table_id):
+    """
+    table_style css rules as Styler.set_table_styles writes them, scoped to a table's id
+    """
+    rules = []
+    for style in table_style:
+        props = "".join("  {}: {};\n".format(k, v) for k, v in style["props"])
+        rules.append("#{} {} {{\n{}}}\n".format(table_id, style["selector"], props))
+    return "".join(rules)
+
+
+def table_id():
+    """
+    New unique id for a table element
+    """
+    return "T_" + uuid.uuid4().hex[:5]
+
+
+def _group_thousands(strings):
+    """
+    Insert thousands separators into formatted numbers, eg '-1234567.89' -> '-1,234,567.89'
+    """
+    intpart, point, frac = np.char.partition(strings, ".").T
+    neg = np.char.startswith(intpart, "-")
+    digits = np.char.lstrip(intpart, "-")
+    width = -(-int(np.char.str_len(digits).max(initial=1)) // 3) * 3  # round up to whole groups
+    groups = np.char.rjust(digits, width).view("U1").reshape(len(strings), width // 3, 3)
+    # a comma before every group, then drop the commas (and padding) in front of the first digit
+    sep = np.full(groups.shape[:2] + (1,), ",")
+    grouped = np.concatenate([sep, groups], axis=2).reshape(len(strings), -1)
+    grouped = np.char.lstrip(np.ascontiguousarray(grouped).view("U{}".format(grouped.shape[1])).ravel(), " ,")
+    return np.char.add(np.char.add(np.where(neg, "-", ""), grouped), np.char.add(point, frac))
+
+
+def _format_column(col, fmt=None):
+    """
+    Format a column's values to an array of strings
+    :param fmt: (decimal places, thousands separators), a format string like '{:.1%}',
+        or None for the Styler default display
+    """
+    values = col.to_numpy()
+    if isinstance(fmt, tuple):
+        decimals, thousands = fmt
+        res = np.char.mod("%.{}f".format(decimals), col.to_numpy(dtype=float, na_value=np.nan))
+        return _group_thousands(res) if thousands else res
+    if fmt is not None:
+        return np.array([fmt.format(x) for x in values.tolist()], dtype=str)
+    if pd.api.types.is_float_dtype(col.dtype):
+        return np.char.mod(
+            "%.{}f".format(pd.get_option("styler.format.precision")), col.to_numpy(dtype=float, na_value=np.nan)
+        )
+    return np.asarray(col.astype(str), dtype=str)
+
+
+def _accounting_colors(col):
+    """
+    'red' for negative values, 'green' otherwise, from the numbers rather than formatted strings
+    """
+    if not pd.api.types.is_numeric_dtype(col.dtype):
+        col = pd.to_numeric(col.astype(str).str.replace(",", "").str.replace("%", ""), errors="coerce")
+    return np.where(col.to_numpy(dtype=float, na_value=np.nan) < 0, "red", "green")
+
+
+def _html_table(df, formats, accounting_col_columns):
+    tid = table_id()
+    header = ['<th class="blank level0" >&nbsp;</th>'] + [
+        '<th class="col_heading level0 col{}" >{}</th>'.format(i, col) for i, col in enumerate(df.columns)
+    ]
+    head = "    <tr>\n      {}\n    </tr>\n".format("\n      ".join(header))
+    if df.index.name is not None:
+        names = ['<th class="index_name level0" >{}</th>'.format(df.index.name)] + [
+            '<th class="blank col{}" >&nbsp;</th>'.format(i) for i in range(len(df.columns))
+        ]
+        head += "    <tr>\n      {}\n    </tr>\n".format("\n      ".join(names))
+
+    rows = np.char.add(
+        '    <tr>\n      <th class="row_heading level0" >',
+        np.asarray(df.index.astype(str), dtype=str),
+    )
+    rows = np.char.add(rows, "</th>")
+    for i, col in enumerate(df.columns):
+        cells = _format_column(df.iloc[:, i], formats.get(col))
+        if col in accounting_col_columns:
+            td = np.char.add(np.char.add('\n      <td style="color: ', _accounting_colors(df.iloc[:, i])), '" >')
+        else:
+            td = "\n      <td >"
+        rows = np.char.add(np.char.add(rows, td), np.char.add(cells, "</td>"))
+
+    body = "\n    </tr>\n".join(rows.tolist()) + "\n    </tr>\n" if len(rows) else ""
+    return '<style type="text/css">\n{}</style>\n<table id="{}">\n  <thead>\n{}  </thead>\n  <tbody>\n{}  </tbody>\n</table>\n'.format(
+        table_css(tid), tid, head, body
+    )
+
+
 def generate_table(
     df: pd.DataFrame,
     precision: t.Tuple[int, dict] = None,
     accounting_col_columns: list = None,
+    engine: str = None,
 ):
+    """
+    Render a dataframe as a html table in the table_style look
+    :param df:
+    :param precision: decimal places for all columns, or dict of column to decimal places
+        (written with thousands separators) or format string
+    :param accounting_col_columns: columns to colour red when negative, green otherwise
+    :param engine: 'styler' or 'html' (see table_engines), default default_table_engine
+    :return: html string
+    """
+    engine = engine or default_table_engine
+    if engine not in table_engines:
+        raise ValueError("Unknown engine '{}', expected one of {}".format(engine, table_engines))
+
+    if engine == "html" and not isinstance(df.index, pd.MultiIndex) and not isinstance(df.columns, pd.MultiIndex):
+        if isinstance(precision, int):  # plain decimal places for every column
+            formats = {col: (precision, False) for col in df.columns}
+        else:  # decimal places with thousands separators, or format strings
+            formats = {
+                col: (fmt, True) if isinstance(fmt, int) else fmt
+                for col, fmt in (precision or {}).items()
+                if col in df.columns
+            }
+        return _html_table(df, formats, set(accounting_col_columns or []))
+
     if precision:
         if isinstance(precision, int):
             format_var = "{:.%sf}" % precision
-            df = df.applymap(lambda x: format_var.format(x))
+            df = df.map(lambda x: format_var.format(x))
         elif isinstance(precision, dict):
+            df = df.copy()
             for col, col_precision in precision.items():
                 if col in df.columns:
                     if isinstance(col_precision, int):
@@ -85,10 +216,96 @@ def generate_table(
                     df[col] = df[col].map(format_var.format)
 
     if accounting_col_columns:
-        res = df.style.applymap(
+        res = df.style.map(
             color_accounting, subset=accounting_col_columns
         ).set_table_styles(table_style)
     else:
         res = df.style.set_table_styles(table_style)
 
     return res.to_html()
+
+
+def _payload_dates(values):
+    values = pd.DatetimeIndex(values)
+    # iso dates sort as strings in the browser
+    date_format = "%Y-%m-%d" if (values.dropna() == values.dropna().normalize()).all() else "%Y-%m-%d %H:%M:%S"
+    return pd.Series(values.strftime(date_format)).astype(object).where(values.notna().tolist(), None).tolist()
+
+
+def _payload_value(value):
+    if value is None or value is pd.NaT or (not isinstance(value, str) and pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    if isinstance(value, str):
+        return value
+    return str(value)  # Timestamps, Decimals and anything else json can't hold
+
+
+def _payload_values(values):
+    if isinstance(values, pd.DatetimeIndex) or pd.api.types.is_datetime64_any_dtype(values):
+        return _payload_dates(values)
+    values = pd.Series(values)
+    if pd.api.types.is_float_dtype(values.dtype):
+        arr = values.to_numpy(dtype=float, na_value=np.nan)
+        return pd.Series(arr).astype(object).where(np.isfinite(arr), None).tolist()  # inf isn't valid json
+    if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ("datetime", "datetime64", "date"):
+        try:
+            return _payload_dates(pd.to_datetime(values))
+        except (TypeError, ValueError):  # mixed timezones etc
+            pass
+    return [_payload_value(v) for v in values]
+
+
+def table_payload(df: pd.DataFrame, precision: t.Tuple[int, dict] = None, accounting_col_columns: list = None):
+    """
+    Column oriented payload of a dataframe for the virtual table in the data_table/virtual_table
+    macros. The index is the first column. Numbers are sent as numbers (rounded to their
+    precision) and formatted in the browser, so they can be sorted.
+    :param df:
+    :param precision: decimal places for all columns, or dict of column to decimal places
+        (shown with thousands separators) or format string (formatted here, sorted as text)
+    :param accounting_col_columns: columns to colour red when negative, green otherwise
+    :return: dict of columns, values, formats, numeric and accounting lists, one entry per column
+    """
+    accounting_col_columns = set(accounting_col_columns or [])
+    res = {
+        "columns": ["" if df.index.name is None else str(df.index.name)],
+        "values": [_payload_values(df.index)],
+        "formats": [None],
+        "numeric": [False],
+        "accounting": [False],
+    }
+    for i, name in enumerate(df.columns):
+        col = df.iloc[:, i]
+        fmt = precision if isinstance(precision, int) else (precision or {}).get(name)
+        numeric = pd.api.types.is_numeric_dtype(col.dtype) and not pd.api.types.is_bool_dtype(col.dtype)
+        if isinstance(fmt, str):
+            values, fmt, numeric = list(_format_column(col, fmt)), None, False
+        elif numeric:
+            values = pd.Series(col.to_numpy(dtype=float, na_value=np.nan), index=col.index)
+            if fmt is not None:
+                values = values.round(fmt)
+                fmt = {"decimals": fmt, "thousands": not isinstance(precision, int)}
+            values = _payload_values(values)
+        else:
+            values = _payload_values(col)
+
+        res["columns"].append(str(name))
+        res["values"].append(values)
+        res["formats"].append(fmt)
+        res["numeric"].append(numeric)
+        res["accounting"].append(name in accounting_col_columns)
+    return res
+
+
+def table_payload_json(df: pd.DataFrame, precision: t.Tuple[int, dict] = None, accounting_col_columns: list = None):
+    """
+    table_payload as compact json, safe to put in a <script type="application/json"> block
+    """
+    payload = table_payload(df, precision=precision, accounting_col_columns=accounting_col_columns)
+    return json.dumps(payload, separators=(",", ":"), allow_nan=False).replace("<", "\\u003c")
@@ -1,17 +1,144 @@
-import numpy as np
+import contextlib
+import contextvars
+import functools
+import warnings
+
 import numpy as np
 import pandas as pd
 import plotly
 import plotly.graph_objects as go
+import plotly.io as pio
 from commodutil import dates
 from commodutil import transforms
 
+from commodplot import commodplotprofile as cpp
 from commodplot import commodplottransform as cpt
 from commodplot import commodplotutil as cpu
 from commodplot.commodplotutil import default_line_col, year_col_map
 
 hovertemplate_default = "%{y:.2f}: <i>%{text}</i>"
 
+# when True chart functions return plain {"data": [...], "layout": {...}} dicts instead
+# of go.Figure objects, skipping plotly's property validation. Can also be set per call
+# with raw=True, or for a block of code with the raw_figures context manager.
+# seas_line_plot, seas_line_plot_many, line_plot, reindex_year_line_plot and table_plot
+# build raw figures, other chart functions always return go.Figure
+default_raw_figures = False
+_raw_figures = contextvars.ContextVar("raw_figures", default=None)
+
+default_percentile_bands = [10, 25, 75, 90]
+percentile_band_col = "rgba(70, 130, 180, %s)"  # steelblue, darker for inner bands
+
+
+@contextlib.contextmanager
+def raw_figures(enabled=True):
+    """
+    Context manager to build raw dict figures/traces (enabled=None leaves the current setting)
+    """
+    if enabled is None:
+        yield
+        return
+    token = _raw_figures.set(enabled)
+    try:
+        yield
+    finally:
+        _raw_figures.reset(token)
+
+
+def is_raw():
+    enabled = _raw_figures.get()
+    return default_raw_figures if enabled is None else enabled
+
+
+def raw_capable(func):
+    """
+    Decorator for chart functions which honour a raw=True/False kwarg
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with raw_figures(kwargs.get("raw", None)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def nest_props(props):
+    """
+    Turn plotly style kwargs (with magic underscores eg line_color, xaxis_tickformat)
+    into nested plain dicts, dropping None values as plotly does
+    """
+    res = {}
+    for key, value in props.items():
+        if value is None:
+            continue
+        if isinstance(value, plotly.basedatatypes.BasePlotlyType):
+            value = value.to_plotly_json()  # already nested
+        elif isinstance(value, (pd.Index, pd.Series)):
+            value = value.to_numpy()
+        elif isinstance(value, dict):
+            value = nest_props(value)
+            if not value:
+                continue
+
+        parts = key.split("_")
+        if parts[-1] == "title" and isinstance(value, str):
+            value = {"text": value}  # plain string titles are shorthand for title.text
+        target = res
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        if isinstance(value, dict) and isinstance(target.get(parts[-1]), dict):
+            target[parts[-1]].update(value)
+        else:
+            target[parts[-1]] = value
+    return res
+
+
+def scatter(**props):
+    """
+    Return a go.Scatter, or a plain trace dict when building raw figures
+    """
+    if is_raw():
+        return dict(type="scatter", **nest_props(props))
+    return go.Scatter(**props)
+
+
+def table(**props):
+    """
+    Return a go.Table, or a plain trace dict when building raw figures
+    """
+    if is_raw():
+        return dict(type="table", **nest_props(props))
+    return go.Table(**props)
+
+
+def figure(data, **layout_kwargs):
+    """
+    Return a go.Figure with the given traces and layout, or a plain dict when building raw figures
+    """
+    if is_raw():
+        layout = nest_props(layout_kwargs)
+        if isinstance(layout.get("template"), str):
+            layout["template"] = pio.templates[layout["template"]].to_plotly_json()
+        return {"data": list(data), "layout": layout}
+
+    fig = go.Figure(data=data)
+    fig.update_layout(**layout_kwargs)
+    return fig
+
+
+def is_raw_figure(fig):
+    return isinstance(fig, dict) and "data" in fig and "layout" in fig
+
+
+def to_figure(fig):
+    """
+    Wrap a raw dict figure in a go.Figure (figures are returned as is)
+    """
+    if is_raw_figure(fig):
+        return go.Figure(fig)
+    return fig
+
 
 def get_year_line_col(year):
     """
@@ -80,27 +207,100 @@ def clean_seas_df_for_min_max_average(seas, range):
     :param seas:
     :return:
     """
+    seasf = _clean_seas_df(seas)
+    start_year, end_year = _year_range(range)
+
+    r = seasf[[x for x in seasf.columns if x >= start_year and x <= end_year]]
+    return r
+
+
+def _clean_seas_df(seas):
+    """
+    Drop empty years, rename columns to years and remove years with
+    unusually high amounts of missing data
+    """
     seas = seas.dropna(how="all", axis=1)
     seasf = seas.rename(columns=dates.find_year(seas))
 
     # only consider when we have full(er) data for a given range
-    fulldata = pd.DataFrame(seasf.isna().sum())  # count non-na values
-    if (
-            not (fulldata == 0).all().iloc[0]
-    ):  # line below doesn't apply when we have full data for all columns
-        fulldata = fulldata[
-            fulldata.apply(lambda x: np.abs(x - x.mean()) / x.std() < 1.5).all(axis=1)
-        ]  # filter columns with high emtply values
-    seasf = seasf[fulldata.index]  # use these column names only
+    nacount = seasf.isna().to_numpy().sum(axis=0)
+    if (nacount != 0).any():  # doesn't apply when we have full data for all columns
+        with np.errstate(invalid="ignore", divide="ignore"):
+            zs = np.abs(nacount - nacount.mean()) / nacount.std(ddof=1)
+        seasf = seasf.loc[:, zs < 1.5]  # filter columns with high emtply values
+    return seasf
 
+
+def _year_range(range):
+    """
+    If an int eg 5, then do curyear -1 and curyear -6
+    If list then do the years in that list eg 2012-2019
+    """
     if isinstance(range, int):
         end_year = dates.curyear - 1
         start_year = end_year - (range - 1)
     else:
         start_year, end_year = range[0], range[1]
+    return start_year, end_year
 
-    r = seasf[[x for x in seasf.columns if x >= start_year and x <= end_year]]
-    return r
+
+class SeasonalStats:
+    """
+    Day-of-year statistics for a seasonalised dataframe.
+    The dataframe is cleaned once and the min/max/mean/median/percentiles for a given
+    year range are calculated together and kept, so the shaded range, average line
+    and percentile bands can all be built from the same calculation.
+    """
+
+    def __init__(self, seas, percentiles=None):
+        seasf = _clean_seas_df(seas)
+        self.index = seasf.index
+        self.years = list(seasf.columns)
+        self.values = seasf.to_numpy(dtype=np.float64, na_value=np.nan)
+        self.percentiles = tuple(percentiles or ())
+        self._results = {}
+
+    def stats(self, range):
+        """
+        Return a dataframe of min, max, mean, median and percentile columns (eg p10)
+        for the given year range, along with the number of years used (None if < 2)
+        :param range: int number of years back from last year, or (start_year, end_year)
+        :return:
+        """
+        key = range if isinstance(range, int) else tuple(range)
+        if key not in self._results:
+            self._results[key] = self._calc(range)
+        return self._results[key]
+
+    def _calc(self, range):
+        start_year, end_year = _year_range(range)
+        sel = [i for i, x in enumerate(self.years) if start_year <= x <= end_year]
+        r = self.values[:, sel]
+
+        q = [0, 50, 100] + list(self.percentiles)
+        names = ["min", "median", "max"] + ["p%s" % p for p in self.percentiles]
+        if len(sel) > 0:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)  # all-NaN days
+                qres = np.nanpercentile(r, q, axis=1)
+                mean = np.nanmean(r, axis=1)
+        else:
+            qres = np.full((len(q), len(self.index)), np.nan)
+            mean = qres[0]
+
+        res = pd.DataFrame(dict(zip(names, qres)), index=self.index)
+        res["mean"] = mean
+        rangeyr = len(sel) if len(sel) >= 2 else None
+        return res, rangeyr
+
+
+def seasonal_stats(seas, percentiles=None):
+    """
+    Return SeasonalStats for seas, reusing seas if it is already a SeasonalStats object
+    """
+    if isinstance(seas, SeasonalStats):
+        return seas
+    return SeasonalStats(seas, percentiles=percentiles)
 
 
 def min_max_mean_range(seas, shaded_range):
@@ -108,30 +308,19 @@ def min_max_mean_range(seas, shaded_range):
     Calculate min and max for seas
     If an int eg 5, then do curyear -1 and curyear -6
     If list then do the years in that list eg 2012-2019
-    :param seas:
+    :param seas: seasonalised dataframe or SeasonalStats
     :param shaded_range:
     :return:
     """
-    r = clean_seas_df_for_min_max_average(seas, shaded_range)
-
-    res = r.copy()
-    res["min"] = res.min(1)
-    res["max"] = res.max(1)
-    res["mean"] = res.mean(1)
-    res = res[["min", "max", "mean"]]
-
-    if len(r.columns) >= 2:
-        rangeyr = int(len(r.columns))  # end_year - start_year
-    else:
-        rangeyr = None
-    return res, rangeyr
+    res, rangeyr = seasonal_stats(seas).stats(shaded_range)
+    return res[["min", "max", "mean"]], rangeyr
 
 
 def shaded_range_traces(seas, shaded_range, showlegend=True):
     """
     Given a dataframe, calculate the min/max for every day of the year
     and return this as a trace for the min/max shaded area
-    :param seas:
+    :param seas: seasonalised dataframe or SeasonalStats
     :param shaded_range:
     :param showlegend:
     :return:
@@ -144,7 +333,7 @@ def shaded_range_traces(seas, shaded_range, showlegend=True):
 
     if rangeyr is not None:
         traces = []
-        max_trace = go.Scatter(
+        max_trace = scatter(
             x=r.index,
             y=r["max"].values,
             fill=None,
@@ -156,7 +345,7 @@ def shaded_range_traces(seas, shaded_range, showlegend=True):
             legendgroup="min",
         )
         traces.append(max_trace)
-        min_trace = go.Scatter(
+        min_trace = scatter(
             x=r.index,
             y=r["min"].values,
             fill="tonexty",
@@ -171,16 +360,67 @@ def shaded_range_traces(seas, shaded_range, showlegend=True):
         return traces
 
 
+def percentile_band_traces(seas, band_range, percentiles=None, showlegend=True):
+    """
+    Given a dataframe, calculate percentiles for every day of the year and return
+    fill-between trace pairs for the fan bands eg p10-p90 and p25-p75
+    Percentiles are paired outermost first, so the inner bands are drawn on top
+    :param seas: seasonalised dataframe or SeasonalStats
+    :param band_range: int number of years, or (start_year, end_year)
+    :param percentiles: list of percentiles, defaults to default_percentile_bands
+    :param showlegend:
+    :return:
+    """
+    percentiles = sorted(percentiles or default_percentile_bands)
+    stats = seasonal_stats(seas, percentiles=percentiles)
+    missing = [p for p in percentiles if p not in stats.percentiles]
+    if missing:
+        raise ValueError("SeasonalStats was not calculated for percentiles %s" % missing)
+
+    r, rangeyr = stats.stats(band_range)
+    if rangeyr is None:
+        return None
+
+    if isinstance(band_range, int):
+        name = "%syr" % rangeyr
+    else:
+        name = "%s-%s" % (str(band_range[0])[-2:], str(band_range[1])[-2:])
+
+    x = r.index  # shared by all band traces
+    traces = []
+    npairs = len(percentiles) // 2
+    for i in range(npairs):
+        lower, upper = percentiles[i], percentiles[-1 - i]
+        color = percentile_band_col % round(0.15 * (i + 1), 2)
+        group = "p%s-p%s" % (lower, upper)
+        for p, fill in [(upper, None), (lower, "tonexty")]:
+            traces.append(
+                scatter(
+                    x=x,
+                    y=r["p%s" % p].values,
+                    fill=fill,
+                    fillcolor=color,
+                    name="%s p%s" % (name, p),
+                    mode="lines",
+                    line_color=color,
+                    line_width=0.1,
+                    showlegend=showlegend,
+                    legendgroup=group,
+                )
+            )
+    return traces
+
+
 def average_line_trace(seas, average_line):
     """
     Given a dataframe, calculate the mean for every day of the year
     and return this as a trace for the average line
-    :param seas:
+    :param seas: seasonalised dataframe or SeasonalStats
     :param average_line:
     :return:
     """
     r, rangeyr = min_max_mean_range(seas, average_line)
-    trace = go.Scatter(
+    trace = scatter(
         x=r.index,
         y=r["mean"].values,
         fill=None,
@@ -209,10 +449,13 @@ def timeseries_to_seas_trace(
     :return:
     """
     traces = []
+    # convert shared arrays once - plotly validates pandas objects much more slowly
+    x = seas.index.to_numpy()
+    text = np.asarray(text, dtype=str)  # object arrays are deep copied element by element
     for col in seas.columns:
         trace_kwargs = {
-            "x": seas.index,
-            "y": seas[col],
+            "x": x,
+            "y": seas[col].to_numpy(),
             "hoverinfo": "y",
             "name": str(col),
             "hovertemplate": hovertemplate_default,
@@ -227,7 +470,7 @@ def timeseries_to_seas_trace(
         if line_mode:
             trace_kwargs["mode"] = line_mode
 
-        trace = go.Scatter(**trace_kwargs)
+        trace = scatter(**trace_kwargs)
         traces.append(trace)
 
     return traces
@@ -240,9 +483,14 @@ def timeseries_to_reindex_year_trace(
         current_select_year=None,
         showlegend=True,
         visible_line_years=None,
+        max_points=None,
 ):
     traces = []
     colyearmap = cpu.dates.find_year(dft)
+    x = dft.index.to_numpy()
+    text = np.asarray(text, dtype=str)  # object arrays are deep copied element by element
+    if max_points is not None:
+        xnum = cpt._numeric_index(dft.index)
 
     for col in dft.columns:
         colyear = colyearmap[col]
@@ -252,13 +500,17 @@ def timeseries_to_reindex_year_trace(
                 current_select_year = colyearmap[current_select_year]
             if colyear >= current_select_year:
                 width = 2.2
-        trace = go.Scatter(
-            x=dft.index,
-            y=dft[col],
+        xcol, y, textcol = x, dft[col].to_numpy(), text
+        if max_points is not None:
+            pos = cpt.downsample_positions(xnum, y, max_points)
+            xcol, y, textcol = x[pos], y[pos], text[pos]
+        trace = scatter(
+            x=xcol,
+            y=y,
             hoverinfo="y",
             name=str(col),
             hovertemplate=hovertemplate_default,
-            text=text,
+            text=textcol,
             visible=line_visible(colyear, visible_line_years=visible_line_years, col_name=current_select_year),
             line=dict(color=get_year_line_col(colyear), dash=dash, width=width),
             showlegend=showlegend,
@@ -269,6 +521,17 @@ def timeseries_to_reindex_year_trace(
     return traces
 
 
+def _percentile_bands_kwarg(kwargs):
+    """
+    percentile_bands can be True (use the default bands) or a list of percentiles
+    """
+    percentile_bands = kwargs.get("percentile_bands", None)
+    if percentile_bands is True:
+        return list(default_percentile_bands)
+    return percentile_bands
+
+
+@cpp.traced("traces")
 def seas_plot_traces(df, fwd=None, **kwargs):
     """
     Generate traces for a timeseries that is being turned into a seasonal plot.
@@ -282,7 +545,10 @@ def seas_plot_traces(df, fwd=None, **kwargs):
     histfreq = kwargs.get("histfreq", None)
     if histfreq is None:
         histfreq = cpu.infer_freq(df)
-    seas = cpt.seasonalise(df, histfreq=histfreq)
+    seas_engine = kwargs.get("seas_engine", None)
+    seas = kwargs.get("seas", None)  # already seasonalised eg by seasonalise_many
+    if seas is None:
+        seas = cpt.seasonalise(df, histfreq=histfreq, engine=seas_engine)
 
     text = seas.index.strftime("%b")
     if histfreq in ["B", "D", "W"]:
@@ -292,17 +558,29 @@ def seas_plot_traces(df, fwd=None, **kwargs):
     visible_line_years = kwargs.get("visible_line_years", None)
     line_mode = kwargs.get("line_mode", None)
 
-    # shaded range
+    # shaded range / average line / percentile bands share the same seasonal statistics
     shaded_range = kwargs.get("shaded_range", None)
+    average_line = kwargs.get("average_line", None)
+    percentile_bands = _percentile_bands_kwarg(kwargs)
+    if shaded_range is not None or average_line is not None or percentile_bands:
+        stats = SeasonalStats(seas, percentiles=percentile_bands)
+
+    if percentile_bands:
+        res["percentile_bands"] = percentile_band_traces(
+            stats,
+            kwargs.get("percentile_range", 5),
+            percentile_bands,
+            showlegend=showlegend,
+        )
+
     if shaded_range is not None:
         res["shaded_range"] = shaded_range_traces(
-            seas, shaded_range, showlegend=showlegend
+            stats, shaded_range, showlegend=showlegend
         )
 
     # average line
-    average_line = kwargs.get("average_line", None)
     if average_line is not None:
-        res["average_line"] = average_line_trace(seas, average_line)
+        res["average_line"] = average_line_trace(stats, average_line)
 
     # historical / solid lines
     res["hist"] = timeseries_to_seas_trace(
@@ -318,7 +596,7 @@ def seas_plot_traces(df, fwd=None, **kwargs):
             fwd = transforms.format_fwd(
                 fwd, df.index[-1]
             )  # only applies for forward curves
-        fwdseas = cpt.seasonalise(fwd, histfreq=fwdfreq)
+        fwdseas = cpt.seasonalise(fwd, histfreq=fwdfreq, engine=seas_engine)
 
         res["fwd"] = timeseries_to_seas_trace(
             fwdseas, text, showlegend=showlegend, dash="dot",
@@ -341,12 +619,24 @@ def reindex_plot_traces(df, **kwargs):
     visible_line_years = kwargs.get("visible_line_years", None)
     current_select_year = kwargs.get("current_select_year", None)
 
-    text = df.index.strftime("%d-%b")
+    text = cpu.strftime(df.index, "%d-%b")
 
     shaded_range = kwargs.get("shaded_range", None)
+    percentile_bands = _percentile_bands_kwarg(kwargs)
+    if shaded_range is not None or percentile_bands:
+        stats = SeasonalStats(df, percentiles=percentile_bands)
+
+    if percentile_bands:
+        res["percentile_bands"] = percentile_band_traces(
+            stats,
+            kwargs.get("percentile_range", 5),
+            percentile_bands,
+            showlegend=showlegend,
+        )
+
     if shaded_range is not None:
         res["shaded_range"] = shaded_range_traces(
-            df, shaded_range, showlegend=showlegend
+            stats, shaded_range, showlegend=showlegend
         )
 
     # historical / solid lines
@@ -356,6 +646,7 @@ def reindex_plot_traces(df, **kwargs):
         current_select_year=current_select_year,
         showlegend=showlegend,
         visible_line_years=visible_line_years,
+        max_points=kwargs.get("max_points", None),
     )
 
     return res
@@ -365,10 +656,11 @@ def timeseries_trace(series: pd.Series, **kwargs) -> go.Scatter:
     """
     Return a standard timeseries trace for use in a plotly figure
     :param series: Pandas timeseries of data
-    :param kwargs: kwargs for various formatting options
+    :param kwargs: kwargs for various formatting options, max_points to downsample long series
     :return:
     """
     series = series.dropna()
+    series = cpt.downsample(series, kwargs.get("max_points"))
 
     # name
     name = series.name
@@ -378,7 +670,7 @@ def timeseries_trace(series: pd.Series, **kwargs) -> go.Scatter:
     # hover text formatting
     hover_date_format = kwargs.get("hover_date_format", "%d-%b-%y")
 
-    t = go.Scatter(
+    t = scatter(
         x=series.index,
         y=series.values,
         hoverinfo="y",
@@ -427,6 +719,7 @@ def timeseries_trace_by_year(
         color=color,
         legendgroup=kwargs.get("legendgroup"),
         showlegend=kwargs.get("showlegend"),
+        max_points=kwargs.get("max_points"),
     )
     return t
 
@@ -443,6 +736,7 @@ def line_plot_traces(df, fwd=None, **kwargs):
     colyearmap_enabled = kwargs.get("colyearmap_enabled", True)
     colyearmap = cpu.dates.find_year(df)
     visible_lines = kwargs.get("visible_lines", None)
+    max_points = kwargs.get("max_points", None)
 
     colcount = 0
     for col in df.columns:
@@ -452,7 +746,7 @@ def line_plot_traces(df, fwd=None, **kwargs):
                 isinstance(colyear, str) and colyear.isnumeric())
         ):
             trace = timeseries_trace_by_year(
-                df[col], colyear, legendgroup=col
+                df[col], colyear, legendgroup=col, max_points=max_points
             )  # , text, **kwargs)
         else:
             visible = True
@@ -460,6 +754,7 @@ def line_plot_traces(df, fwd=None, **kwargs):
                 visible = "legendonly"
             trace = timeseries_trace(
                 df[col], legendgroup=col, color=get_sequence_line_col(colcount), visible=visible,
+                max_points=max_points,
             )  #
 
         traces.append(trace)
@@ -479,6 +774,7 @@ def line_plot_traces(df, fwd=None, **kwargs):
                     colyear,
                     legendgroup=col,
                     showlegend=False,
+                    max_points=max_points,
                 )  # , text, **kwargs)
             else:
                 visible = True
@@ -490,7 +786,8 @@ def line_plot_traces(df, fwd=None, **kwargs):
                     legendgroup=col,
                     showlegend=False,
                     color=get_sequence_line_col(colcount),
-                    visible=visible
+                    visible=visible,
+                    max_points=max_points,
                 )
             traces.append(trace)
 
@@ -1,13 +1,169 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
+from commodutil import dates
+from commodutil import pandasutil
 from commodutil import transforms
 
+# engine used by seasonalise when none is given explicitly
+#   commodutil - delegate to commodutil.transforms (pandas groupby/pivot per year)
+#   native     - single pass numpy mapping of timestamps onto a (day-of-year, year) grid
+default_seasonalise_engine = "commodutil"
+seasonalise_engines = ("commodutil", "native")
+
+# which curve snapshots decimate_snapshots keeps: (max age in days from the latest snapshot,
+# period) tiers, keeping the latest snapshot in each period. Older than every tier are dropped.
+# Default is every snapshot for the last week, weekly for the last quarter, monthly beyond
+default_snapshot_policy = ((7, "D"), (92, "W"), (None, "M"))
+
+
+class FrameCache:
+    """
+    LRU cache of transformed dataframes keyed by a hash of the input data.
+    Bounded by the total memory of the cached frames. Frames are copied on the
+    way in and out so callers can't mutate the cached copy.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._frames:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._frames.move_to_end(key)
+            return self._frames[key][0].copy()
+
+    def put(self, key, df):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key)[1]
+            self._frames[key] = (df.copy(), size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._frames.popitem(last=False)
+                self.nbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._frames),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_cache = None  # FrameCache when caching is enabled
+
+
+def enable_cache(max_bytes=256 * 1024 * 1024):
+    """
+    Turn on caching of seasonalise and reindex_year results
+    :param max_bytes: upper bound on memory used by cached frames
+    :return:
+    """
+    global _cache
+    _cache = FrameCache(max_bytes=max_bytes)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def clear_cache():
+    """
+    Invalidate all cached results (counters are kept)
+    """
+    if _cache is not None:
+        _cache.clear()
+
+
+def cache_info():
+    """
+    Return dict of hits, misses, entries and bytes used, or None if caching is off
+    """
+    if _cache is not None:
+        return _cache.info()
+
+
+def data_fingerprint(df, *args):
+    """
+    Cheap content hash of a series/dataframe (index, values and names) plus any extra args
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    names = df.columns if isinstance(df, pd.DataFrame) else [df.name]
+    h.update(repr((list(names), df.index.name, args)).encode("utf8"))
+    return h.hexdigest()
+
+
+def _cached(func, df, *args):
+    if _cache is None:
+        return func(df, *args)
+
+    # results are aligned to the current year, so a new year must not reuse last year's
+    key = (func.__name__, dates.curyear, data_fingerprint(df, *args))
+    res = _cache.get(key)
+    if res is None:
+        res = func(df, *args)
+        _cache.put(key, res)
+    return res
+
+
+def reindex_year(df):
+    """
+    Reindex yearly columns to the current year (see commodutil transforms.reindex_year),
+    using the cache if enabled
+    :param df:
+    :return:
+    """
+    return _cached(transforms.reindex_year, df)
+
 
-def seasonalise(df, histfreq):
+def seasonalise(df, histfreq, engine=None):
     """
-    Given a dataframe, seasonalise the data, returning seasonalised dataframe
+    Given a dataframe, seasonalise the data, returning seasonalised dataframe.
+    Results are cached when enable_cache has been called.
     :param df:
+    :param histfreq:
+    :param engine: 'commodutil' or 'native', defaults to default_seasonalise_engine
     :return:
     """
+    engine = engine or default_seasonalise_engine
+    if engine not in seasonalise_engines:
+        raise ValueError(
+            "Unknown seasonalise engine '{}', expected one of {}".format(
+                engine, seasonalise_engines
+            )
+        )
+    return _cached(_seasonalise, df, histfreq, engine)
+
+
+def _seasonalise(df, histfreq, engine):
+    if engine == "native":
+        return seasonalise_native(df, histfreq)
+
     # Prefer core seasonalization in commodutil (newer versions).
     if hasattr(transforms, "seasonalize"):
         return transforms.seasonalize(df, histfreq=histfreq)
@@ -28,3 +184,381 @@ def seasonalise(df, histfreq):
 
     seas = seas.dropna(how="all", axis=1)  # dont plot empty years
     return seas
+
+
+def seasonalise_native(df, histfreq=None):
+    """
+    Seasonalise using numpy integer date arithmetic rather than a pandas pivot.
+    Produces the same layout as commodutil: index of dates in the current year,
+    one column per year. Only the first column of a dataframe is used.
+    :param df:
+    :param histfreq:
+    :return:
+    """
+    if isinstance(df, pd.DataFrame):
+        df = df[df.columns[0]]
+
+    if histfreq is None:
+        histfreq = pd.infer_freq(df.index) if len(df) >= 3 else None
+        if histfreq is None:
+            histfreq = "D"
+
+    if histfreq.startswith("W"):
+        seas = _seasonalise_weekly_native(df)
+    else:
+        seas = _seasonalise_daily_native(df)
+
+    seas = seas.dropna(how="all", axis=1)  # dont plot empty years
+    return seas
+
+
+def _civil_parts(days):
+    """
+    Split an array of days since epoch into year, month and day arrays
+    """
+    d = days.astype("datetime64[D]")
+    years = d.astype("datetime64[Y]")
+    months = d.astype("datetime64[M]")
+    year = years.astype(np.int64) + 1970
+    month = (months - years).astype(np.int64) + 1
+    day = (d - months).astype(np.int64) + 1
+    return year, month, day
+
+
+def _grid_mean(rowkey, colkey, values):
+    """
+    Average values onto a 2d grid given integer row and column codes.
+    Cells with no (non-NaN) observations are NaN.
+    """
+    rows, rowpos = np.unique(rowkey, return_inverse=True)
+    cols, colpos = np.unique(colkey, return_inverse=True)
+    cell = rowpos * len(cols) + colpos
+    valid = ~np.isnan(values)
+    size = len(rows) * len(cols)
+    sums = np.bincount(cell, weights=np.where(valid, values, 0.0), minlength=size)
+    counts = np.bincount(cell, weights=valid, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        grid = np.where(counts > 0, sums / counts, np.nan)
+    return rows, cols, grid.reshape(len(rows), len(cols))
+
+
+def _seasonalise_daily_native(series):
+    """
+    Daily, business day and monthly data: average by (month, day, year),
+    dropping leap days, then fill gaps between the first and last values of each year
+    """
+    return _seasonalise_daily_stacked([series])[0]
+
+
+def _seasonalise_daily_stacked(series_list):
+    """
+    Seasonalise several daily series with one grid reduction over (series, month-day, year)
+    """
+    values = np.concatenate(
+        [s.to_numpy(dtype=np.float64, na_value=np.nan) for s in series_list]
+    )
+    days = np.concatenate(
+        [s.index.to_numpy().astype("datetime64[D]") for s in series_list]
+    )
+    sid = np.repeat(np.arange(len(series_list)), [len(s) for s in series_list])
+    year, month, day = _civil_parts(days)
+
+    keep = ~((month == 2) & (day == 29))
+    year, month, day, values, sid = year[keep], month[keep], day[keep], values[keep], sid[keep]
+
+    rowkey, years, grid = _grid_mean(sid * 512 + month * 32 + day, year, values)
+    rowsid = rowkey // 512
+    mdkey = rowkey % 512
+
+    curmonth = np.datetime64(str(dates.curyear), "M") + (mdkey // 32 - 1)
+    alldates = curmonth.astype("datetime64[D]") + (mdkey % 32 - 1)
+
+    res = []
+    for i, series in enumerate(series_list):
+        lo, hi = np.searchsorted(rowsid, [i, i + 1])
+        sub = grid[lo:hi]
+        present = ~np.isnan(sub).all(axis=0)  # years with data for this series
+        columns = pd.Index(years[present].astype(np.int32), name=series.index.name)
+        seas = pd.DataFrame(
+            sub[:, present], index=pd.DatetimeIndex(alldates[lo:hi]), columns=columns
+        )
+        res.append(pandasutil.fillna_downbet(seas))
+    return res
+
+
+def seasonalise_many(mapping, histfreq=None):
+    """
+    Seasonalise a dict of series with the native engine. Daily, business day and
+    monthly series are stacked and reduced together, weekly series are done one by one.
+    :param mapping: dict of name to series (first column used for dataframes)
+    :param histfreq: frequency shared by all series, inferred per series if None
+    :return: dict of name to seasonalised dataframe
+    """
+    daily, res = {}, {}
+    for name, series in mapping.items():
+        if isinstance(series, pd.DataFrame):
+            series = series[series.columns[0]]
+        freq = histfreq
+        if freq is None:
+            freq = pd.infer_freq(series.index) if len(series) >= 3 else None
+        if freq is not None and freq.startswith("W"):
+            res[name] = seasonalise_native(series, freq)
+        else:
+            daily[name] = series
+
+    if daily:
+        for name, seas in zip(daily, _seasonalise_daily_stacked(list(daily.values()))):
+            res[name] = seas.dropna(how="all", axis=1)
+
+    return {name: res[name] for name in mapping}
+
+
+def _iso_parts(days):
+    """
+    ISO year, week and weekday (1=Monday) for an array of days since epoch
+    """
+    days = days.astype(np.int64)
+    weekday = (days + 3) % 7  # 1970-01-01 was a Thursday, Monday=0
+    thursday = days - weekday + 3
+    isoyear, _, _ = _civil_parts(thursday)
+    jan1 = (isoyear - 1970).astype("datetime64[Y]").astype("datetime64[D]").astype(np.int64)
+    week = (thursday - jan1) // 7 + 1
+    return isoyear, week, weekday + 1
+
+
+def _seasonalise_weekly_native(series):
+    """
+    Weekly data: one value per (ISO year, ISO week) using the most common weekday.
+    Weeks missing that weekday take the last observation in the week (as commodutil does),
+    and the result is aligned to the same ISO week/weekday in the current year.
+    """
+    values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    days = series.index.to_numpy().astype("datetime64[D]")
+    isoyear, week, isoday = _iso_parts(days)
+
+    intended = int(np.bincount(isoday).argmax())
+    key = isoyear * 54 + week
+    pos = np.arange(len(key))
+
+    # weeks that have an observation on the intended weekday use the first non-NaN one
+    on_day = isoday == intended
+    on_day_keys = np.unique(key[on_day])
+    first = np.argsort(days, kind="stable")
+    first = first[on_day[first] & ~np.isnan(values[first])]
+    _, firstpos = np.unique(key[first], return_index=True)
+    chosen = {k: np.nan for k in on_day_keys}
+    chosen.update(zip(key[first][firstpos].tolist(), values[first][firstpos].tolist()))
+
+    # weeks (1-52) without the intended weekday take their last observation
+    missing = ~np.isin(key, on_day_keys) & (week <= 52)
+    rev = pos[missing][::-1]
+    _, lastpos = np.unique(key[rev], return_index=True)
+    chosen.update(zip(key[rev][lastpos].tolist(), values[rev][lastpos].tolist()))
+
+    keys = np.fromiter(chosen.keys(), dtype=np.int64, count=len(chosen))
+    vals = np.fromiter(chosen.values(), dtype=np.float64, count=len(chosen))
+    weeks, years, grid = _grid_mean(keys % 54, keys // 54, vals)
+
+    curyear = dates.curyear
+    if _iso_parts(np.array([np.datetime64("{}-12-31".format(curyear))]))[1][0] != 53:
+        grid = grid[weeks != 53]
+        weeks = weeks[weeks != 53]
+
+    jan4 = np.datetime64("{}-01-04".format(curyear)).astype(np.int64)
+    monday = jan4 - (jan4 + 3) % 7
+    index = (monday + (weeks - 1) * 7 + (intended - 1)).astype("datetime64[D]")
+
+    columns = pd.Index(years.astype(np.int64), name="year")
+    return pd.DataFrame(grid, index=pd.DatetimeIndex(index), columns=columns)
+
+
+def _numeric_index(index):
+    """
+    Index as float positions for downsampling: nanoseconds from the first
+    timestamp for datetimes, the values for numeric indexes, otherwise 0..n-1
+    """
+    if isinstance(index, pd.DatetimeIndex):
+        i8 = index.asi8
+        return (i8 - i8[0]).astype(np.float64) if len(i8) else i8.astype(np.float64)
+    if pd.api.types.is_numeric_dtype(index):
+        return index.to_numpy(dtype=np.float64)
+    return np.arange(len(index), dtype=np.float64)
+
+
+def _lttb_select(x, y, bucket, starts, px, py, nx, ny):
+    """
+    For each bucket pick the point forming the largest triangle with the
+    previous (px, py) and next (nx, ny) anchors of that bucket
+    """
+    pxb, pyb = px[bucket], py[bucket]
+    area = np.abs((pxb - nx[bucket]) * (y - pyb) - (pxb - x) * (ny[bucket] - pyb))
+    best = np.maximum.reduceat(area, starts)
+    candidates = np.flatnonzero(area == best[bucket])
+    _, first = np.unique(bucket[candidates], return_index=True)
+    return candidates[first]
+
+
+def lttb(x, y, max_points):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a finite (no NaN) series.
+    The first and last points are always kept. Rather than walking the buckets
+    one at a time every bucket is solved at once with numpy, repeating until the
+    chosen points match the sequential algorithm.
+    :param x: numeric x values (sorted)
+    :param y: y values
+    :param max_points: number of points to return
+    :return: array of positions into x/y
+    """
+    n = len(x)
+    if max_points is None or n <= max_points or n < 3:
+        return np.arange(n)
+    if max_points < 3:
+        return np.array([0, n - 1])
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    xi, yi = x[1:-1], y[1:-1]
+
+    nbuckets = max_points - 2
+    edges = (np.arange(nbuckets + 1) * (n - 2)) // nbuckets
+    starts = edges[:-1]
+    counts = np.diff(edges)
+    bucket = np.repeat(np.arange(nbuckets), counts)
+
+    xmean = np.add.reduceat(xi, starts) / counts
+    ymean = np.add.reduceat(yi, starts) / counts
+    nx, ny = np.append(xmean[1:], x[-1]), np.append(ymean[1:], y[-1])
+
+    # the left anchor of each bucket is the point chosen for the bucket before it.
+    # Start from the bucket means and re-solve until the choices settle - pass k is
+    # exact for the first k buckets so this always ends, normally after a few passes
+    px, py = np.insert(xmean[:-1], 0, x[0]), np.insert(ymean[:-1], 0, y[0])
+    sel = None
+    for _ in range(nbuckets):
+        prev, sel = sel, _lttb_select(xi, yi, bucket, starts, px, py, nx, ny)
+        if prev is not None and np.array_equal(prev, sel):
+            break
+        px, py = np.insert(xi[sel[:-1]], 0, x[0]), np.insert(yi[sel[:-1]], 0, y[0])
+
+    return np.concatenate([[0], sel + 1, [n - 1]])
+
+
+def downsample_positions(x, y, max_points):
+    """
+    Positions to keep when drawing y against x with at most (roughly) max_points points.
+    Each run of non-NaN values is downsampled with lttb, keeping its first and last
+    observation, and the first NaN of each gap is kept so lines stay broken.
+    :param x: numeric x values (see _numeric_index)
+    :param y: y values, may contain NaN
+    :param max_points:
+    :return: sorted array of positions
+    """
+    n = len(y)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    change = np.diff(np.concatenate([[0], valid.astype(np.int8), [0]]))
+    run_starts = np.flatnonzero(change == 1)
+    run_ends = np.flatnonzero(change == -1)
+
+    gaps = run_ends[run_ends < n]
+    if n and not valid[0]:
+        gaps = np.insert(gaps, 0, 0)
+
+    total = int(valid.sum())
+    budget = max(max_points - len(gaps), 2 * len(run_starts))
+    keep = [gaps]
+    for start, end in zip(run_starts, run_ends):
+        m = max(2, int(round(budget * (end - start) / total)))
+        keep.append(start + lttb(x[start:end], y[start:end], m))
+
+    return np.sort(np.concatenate(keep))
+
+
+def downsample(series, max_points):
+    """
+    Downsample a series for plotting with lttb (see downsample_positions).
+    Returns the series unchanged if max_points is None or it is already short enough.
+    :param series:
+    :param max_points:
+    :return:
+    """
+    if max_points is None or len(series) <= max_points:
+        return series
+
+    x = _numeric_index(series.index)
+    y = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.iloc[downsample_positions(x, y, max_points)]
+
+
+def downsample_ohlc(df, max_points):
+    """
+    Aggregate Open/High/Low/Close data into max_points equal sized buckets of rows.
+    Each bucket is labelled by its first date, takes the first open, highest high,
+    lowest low and last close, so the final close is preserved.
+    :param df: dataframe with Open, High, Low and Close columns
+    :param max_points:
+    :return:
+    """
+    n = len(df)
+    if max_points is None or n <= max_points:
+        return df
+
+    edges = (np.arange(max_points + 1) * n) // max_points
+    starts = edges[:-1]
+    return pd.DataFrame(
+        {
+            "Open": df["Open"].to_numpy()[starts],
+            "High": np.fmax.reduceat(df["High"].to_numpy(dtype=np.float64), starts),
+            "Low": np.fmin.reduceat(df["Low"].to_numpy(dtype=np.float64), starts),
+            "Close": df["Close"].to_numpy()[edges[1:] - 1],
+        },
+        index=df.index[starts],
+    )
+
+
+def snapshot_dates(labels, dayfirst=None, format=None):
+    """
+    Parse curve snapshot column labels (eg '08/06/2021' or Timestamps) to a DatetimeIndex
+    :param labels:
+    :param dayfirst: True to read labels like 01/02/2024 as 1 Feb, False as 2 Jan
+    :param format: strftime format of the labels, eg '%d/%m/%Y'
+    Without dayfirst or format each label is parsed on its own as pd.to_datetime would
+    (month first unless that can't be a date), so one label never changes how the others are read
+    """
+    if isinstance(labels, pd.DatetimeIndex):
+        return labels
+    if dayfirst is None and format is None:
+        return pd.DatetimeIndex(pd.to_datetime(labels, format="mixed"))
+    return pd.DatetimeIndex(pd.to_datetime(labels, dayfirst=bool(dayfirst), format=format))
+
+
+def decimate_snapshots(snapshots, policy=None):
+    """
+    Thin out a history of curve snapshots, keeping recent ones densely and older ones sparsely
+    :param snapshots: DatetimeIndex of snapshot dates, in any order
+    :param policy: tiers of (max age in days or None, period), default default_snapshot_policy
+    :return: sorted positions into snapshots of the ones to keep
+    """
+    policy = policy or default_snapshot_policy
+    if len(snapshots) == 0:
+        return np.arange(0)
+
+    values = snapshots.to_numpy().astype("datetime64[D]")
+    age = (values.max() - values).astype(np.int64)
+    keep = np.zeros(len(values), dtype=bool)
+    done = np.zeros(len(values), dtype=bool)
+    for max_age, period in policy:
+        tier = ~done if max_age is None else ~done & (age <= max_age)
+        done |= tier
+        positions = np.flatnonzero(tier)
+        if not len(positions):
+            continue
+        periods = snapshots[positions].to_period(period).asi8
+        # latest snapshot within each period
+        order = np.lexsort((values[positions], periods))
+        last = np.r_[periods[order][1:] != periods[order][:-1], True]
+        keep[positions[order[last]]] = True
+    return np.flatnonzero(keep)
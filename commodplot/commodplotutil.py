@@ -1,7 +1,8 @@
+import re
+
 import pandas as pd
 import numpy as np
 from commodutil import dates
-from commodutil import transforms
 
 try:
     from commodutil import stats as custats
@@ -60,38 +61,107 @@ def gen_title(df, **kwargs):
     return title
 
 
-def seas_table(hist, fwd=None):
-    hist = hist.resample("MS").mean()
+seas_table_periods = list(pd.date_range("2000-01-01", periods=12, freq="MS").strftime("%b")) + [
+    "Q1", "Q2", "Q3", "Q4", "Q1+Q4", "Q2+Q3", "Year",
+]
+
+
+def _nanmean(values, axis):
+    # mean ignoring NaN, NaN where there are no values (without numpy's empty slice warning)
+    count = (~np.isnan(values)).sum(axis=axis)
+    total = np.nansum(values, axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
 
-    df = hist
+def _month_number(index):
+    return index.year * 12 + index.month - 1
+
+
+def seas_table(hist, fwd=None):
+    """
+    Seasonal summary of a history: average of each month by year, then the quarters,
+    winter (Q1+Q4), summer (Q2+Q3) and calendar year, rounded to 2dp. Everything comes
+    from one aggregation of the history by (year, month). Missing months between months
+    with data take the previous month's average, as commodutil's fillna_downbet.
+    :param hist: Series, or DataFrame of several series
+    :param fwd: optional monthly forward curve(s) to continue the history, starting
+        in its last month or the month after. A DataFrame with the same columns for a DataFrame hist
+    :return: DataFrame of periods (seas_table_periods) by year. For a DataFrame hist the
+        index is (series, period)
+    """
+    frame = hist.to_frame() if isinstance(hist, pd.Series) else hist
 
     if fwd is not None:
-        if fwd.index[0] == hist.index[-1]:
-            hist = hist[:-1]
-            df = pd.concat([hist, fwd], sort=False)
-        elif (fwd.index[0].year - hist.index[-1].year) + (
-            fwd.index[0].month - hist.index[-1].month
-        ) == 1:
-            df = pd.concat([hist, fwd], sort=False)
-
-    df = transforms.seasonailse(df)
-
-    summary = df.resample("Q").mean()
-    winter = summary.iloc[[0, 3], :].mean()
-    winter.name = "Q1+Q4"
-    summer = summary.iloc[[1, 2], :].mean()
-    summer.name = "Q2+Q3"
-    summary.index = ["Q1", "Q2", "Q3", "Q4"]
-    summary = pd.concat([summary, pd.DataFrame([winter])])
-    summary = pd.concat([summary, pd.DataFrame([summer])])
-    cal = df.resample("Y").mean().iloc[0]
-    cal.name = "Year"
-    summary = pd.concat([summary, pd.DataFrame([cal])])
-    summary = round(summary, 2)
-
-    df.index = df.index.strftime("%b")
-    df = pd.concat([df, summary], sort=False).round(2)
-    return df
+        fwd = fwd.to_frame(frame.columns[0]) if isinstance(fwd, pd.Series) else fwd
+        last_month = _month_number(frame.index[-1:])[0]
+        fwd_month = _month_number(fwd.index[:1])[0]
+        if fwd_month == last_month:  # forward curve replaces the current month
+            frame = frame[_month_number(frame.index) < fwd_month]
+            frame = pd.concat([frame, fwd], sort=False)
+        elif fwd_month == last_month + 1:
+            frame = pd.concat([frame, fwd], sort=False)
+
+    months = frame.groupby([frame.index.year, frame.index.month]).mean()
+    years = months.index.get_level_values(0).unique().sort_values()
+
+    # (series, month, year) array of monthly averages
+    values = np.full((len(frame.columns), 12, len(years)), np.nan)
+    values[:, months.index.get_level_values(1) - 1, years.get_indexer(months.index.get_level_values(0))] = (
+        months.to_numpy(dtype=float).T
+    )
+    # fill gaps inside each year, along the months
+    values = (
+        pd.DataFrame(values.transpose(1, 0, 2).reshape(12, -1))
+        .ffill(limit_area="inside")
+        .to_numpy()
+        .reshape(12, len(frame.columns), len(years))
+        .transpose(1, 0, 2)
+    )
+
+    quarters = _nanmean(values.reshape(len(frame.columns), 4, 3, len(years)), axis=2)
+    table = np.concatenate(
+        [
+            values,
+            quarters,
+            _nanmean(quarters[:, [0, 3]], axis=1)[:, None],
+            _nanmean(quarters[:, [1, 2]], axis=1)[:, None],
+            _nanmean(values, axis=1)[:, None],
+        ],
+        axis=1,
+    ).round(2)
+
+    columns = pd.Index(years, name=frame.index.name)
+    if isinstance(hist, pd.Series):
+        return pd.DataFrame(table[0], index=seas_table_periods, columns=columns)
+    index = pd.MultiIndex.from_product([frame.columns, seas_table_periods])
+    return pd.DataFrame(table.reshape(-1, len(years)), index=index, columns=columns)
+
+
+def strftime(index, date_format):
+    """
+    Format a DatetimeIndex as a numpy array of strings. When the format only uses
+    day/month fields (eg %d-%b) each distinct day of the year is formatted once
+    rather than every element
+    :param index:
+    :param date_format:
+    :return:
+    """
+    directives = set(re.findall(r"%.", date_format)) - {"%%"}
+    if not directives <= {"%d", "%b", "%B", "%m", "%e"}:
+        return np.asarray(index.strftime(date_format), dtype=str)
+
+    days = index.to_numpy().astype("datetime64[D]")
+    doy = (days - days.astype("datetime64[M]")).astype(np.int64) + 32 * (
+        days.astype("datetime64[M]").astype(np.int64) % 12
+    )
+    keys, inverse = np.unique(doy, return_inverse=True)
+    # format in a leap year so 29-Feb is available
+    months = np.datetime64("2000-01", "M") + keys // 32
+    labels = pd.DatetimeIndex(months.astype("datetime64[D]") + keys % 32).strftime(
+        date_format
+    )
+    return np.asarray(labels, dtype=str)[inverse]
 
 
 def delta_summary_str(df, precision_format: str = None):
@@ -1,39 +1,218 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import json
 import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
 import plotly as pl
 import plotly.graph_objects as go
+import plotly.io as pio
 import logging
-from jinja2 import PackageLoader, FileSystemLoader, Environment
+from jinja2 import PackageLoader, FileSystemLoader, ChoiceLoader, Environment, FileSystemBytecodeCache
+from plotly.io.json import to_json_plotly
+
+from commodplot import commodplotimage as cpi
+from commodplot import commodplotprofile as cpp
+from commodplot import commodplottable as cptab
+from commodplot.commodplottrace import is_raw_figure
+
+# plotly>=6 encodes numeric arrays as base64 typed arrays in Figure.to_dict, raw figures
+# are encoded the same way so both give the same json (see _typed_array)
+typed_arrays = int(pl.__version__.split(".")[0]) >= 6
+typed_array_dtypes = {
+    "int8": "i1", "uint8": "u1", "int16": "i2", "uint16": "u2",
+    "int32": "i4", "uint32": "u4", "float32": "f4", "float64": "f8",
+}
+typed_array_skip_keys = {"geojson", "layer", "layers", "range"}
 
 
 narrow_margin = {"l": 2, "r": 2, "t": 30, "b": 10}
 
-def convert_dict_plotly_fig_png(d):
+# Optimized config to reduce HTML size and improve performance
+plhtml_config = {
+    'responsive': True,      # Auto-resize with container
+    'displaylogo': False,    # Remove Plotly logo
+    'modeBarButtonsToRemove': ['lasso2d', 'select2d'],  # Remove unused tools
+}
+
+# how plhtml writes trace data into the page
+#   json   - plotly.offline.plot output, dates as ISO strings
+#   binary - dates as base64 float64 typed arrays (ms since epoch) on date axes and arrays
+#            repeated across traces (eg the seasonal x axis) written once per figure
+default_html_encoding = "json"
+html_encodings = ("json", "binary")
+shared_array_min_size = 64  # only dedupe arrays whose json is at least this long
+
+# when plhtml draws charts
+#   eager - Plotly.newPlot runs as the page loads
+#   lazy  - the figure json sits in an inert script block and the loader in base.html
+#           draws it when it scrolls into view (and can purge it again once far away)
+default_html_render = "eager"
+html_render_modes = ("eager", "lazy")
+lazy_placeholder_height = 450  # plotly's default figure height
+
+# render_html keeps one jinja Environment per loader configuration (the most recently used
+# max_environments of them), so each template is parsed and compiled once. Setting
+# default_template_cache_dir (or $COMMODPLOT_TEMPLATE_CACHE) also writes compiled templates
+# there so new processes skip compiling them too.
+# auto_reload checks the template files' mtimes on every render and recompiles on change.
+default_template_auto_reload = True
+default_template_cache_dir = os.environ.get("COMMODPLOT_TEMPLATE_CACHE")
+max_environments = 32
+
+_environments = OrderedDict()
+_environments_lock = threading.Lock()
+
+# which plotly.js base.html loads
+#   cdn    - script tag for the bundle on cdn.plot.ly
+#   inline - the bundle's source written into the page, for offline use. Read from
+#            plotlyjs_dir (files named as on the cdn, eg plotly-basic-2.35.2.min.js), or
+#            the plotly.js shipped with the plotly package when that is plotlyjs_version
+# The full bundle is used unless render_html is asked to infer_plotlyjs_bundle, which picks
+# the smallest bundle for the figures in data. Only do that when every chart on the page
+# is a figure in data (not a div made beforehand or a figure set in template_globals).
+default_plotlyjs = "cdn"
+plotlyjs_modes = ("cdn", "inline")
+plotlyjs_version = "2.35.2"
+plotlyjs_dir = os.environ.get("COMMODPLOT_PLOTLYJS_DIR")
+default_infer_plotlyjs_bundle = False
+
+# partial bundles of plotly.js, smallest first. Anything not covered uses the full bundle
+plotlyjs_bundles = (
+    ("basic", {"scatter", "bar", "pie"}),
+    ("finance", {"scatter", "bar", "pie", "histogram", "funnel", "funnelarea", "waterfall", "ohlc", "candlestick"}),
+    ("cartesian", {
+        "scatter", "bar", "pie", "box", "violin", "histogram", "histogram2d", "histogram2dcontour",
+        "heatmap", "contour", "image", "scatterternary",
+    }),
+)
+
+
+def is_figure(value):
+    """
+    True for plotly figures and raw dict figures (see commodplottrace.figure)
+    """
+    return isinstance(value, go.Figure) or is_raw_figure(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _template_json(name):
+    return pio.templates[name].to_plotly_json()
+
+
+def _copy_containers(obj):
+    """
+    Copy nested dicts/lists but not the arrays they hold
+    """
+    if isinstance(obj, dict):
+        return {k: _copy_containers(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_copy_containers(v) for v in obj]
+    return obj
+
+
+def _typed_array(values):
+    """
+    plotly.js typed array spec ({"dtype", "bdata"}) for a numeric array, as plotly writes them.
+    int64/uint64 are narrowed to the smallest type holding the values, arrays that can't be
+    encoded are returned as they are
+    """
+    values = np.asarray(values)
+    if values.size == 0:
+        return values
+    if values.dtype in (np.int64, np.uint64):
+        narrower = (np.int8, np.int16, np.int32) if values.dtype == np.int64 else (np.uint8, np.uint16, np.uint32)
+        low, high = values.min(), values.max()
+        dtype = next((t for t in narrower if np.iinfo(t).min <= low and high <= np.iinfo(t).max), None)
+        if dtype is None:
+            return values
+        values = values.astype(dtype)
+
+    code = typed_array_dtypes.get(str(values.dtype))
+    if code is None:
+        return values
+    res = {"dtype": code, "bdata": base64.b64encode(np.ascontiguousarray(values)).decode("ascii")}
+    if values.ndim > 1:
+        res["shape"] = str(values.shape)[1:-1]
+    return res
+
+
+def _encode_typed_arrays(obj):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in typed_array_skip_keys:
+                continue
+            if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+                obj[key] = _typed_array(value)
+            else:
+                _encode_typed_arrays(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _encode_typed_arrays(value)
+
+
+def _prepare_raw_figure(fig, margin=None):
     """
-    Given a dict (that might be passed to jinja), convert all plotly figures png
+    Shallow copy a raw dict figure, applying the default template (as go.Figure would)
+    and the margin/automargin settings plhtml applies to figures
     """
+    data = [_copy_containers(trace) for trace in fig["data"]]
+    if typed_arrays:
+        _encode_typed_arrays(data)  # as Figure.to_dict does
+
+    layout = dict(fig["layout"])
+    layout.setdefault("template", _template_json(pio.templates.default))
+    if margin is not None:
+        layout["margin"] = margin
+        axes = {"xaxis", "yaxis"}
+        axes.update(k for k in layout if re.match(r"^[xy]axis\d*$", k))
+        for axis in axes:
+            layout[axis] = dict(layout.get(axis, {}), automargin=True)
+    return {"data": data, "layout": layout}
+
+
+def _find_figures(d, found=None):
+    """
+    (container, key) of every plotly figure in a dict (that might be passed to jinja),
+    looking in nested dicts and lists held by the dict
+    """
+    found = [] if found is None else found
     for k, v in d.items():
-        if isinstance(d[k], go.Figure):
-            d[k] = plpng(d[k])
-        if isinstance(d[k], dict):
-            convert_dict_plotly_fig_png(d[k])
-        if isinstance(d[k], list):
-            for count, item in enumerate(d[k]):
-                if isinstance(item, go.Figure):
-                    d[k][count] = plpng(item)
+        if is_figure(v):
+            found.append((d, k))
+        elif isinstance(v, dict):
+            _find_figures(v, found)
+        elif isinstance(v, list):
+            for count, item in enumerate(v):
+                if is_figure(item):
+                    found.append((v, count))
+    return found
 
-    return d
 
+@cpp.traced("convert")
+def convert_dict_plotly_fig_png(d, workers=None, timeout=None):
+    """
+    Given a dict (that might be passed to jinja), convert all plotly figures png.
+    All figures are collected first and rendered concurrently (see plpng_many).
+    """
+    found = _find_figures(d)
+    pngs = plpng_many([container[key] for container, key in found], workers=workers, timeout=timeout)
+    for (container, key), png in zip(found, pngs):
+        container[key] = png
 
-def plpng(fig):
-    """Convert a plotly figure to a PNG image embedded in a data URI"""
-    import plotly.io as pio
-    import base64
+    return d
 
-    # Get binary PNG data without trying to decode it
-    img_bytes = pio.to_image(fig, format='png')
 
+def _png_img(img_bytes):
+    """PNG bytes as an img tag with a data URI"""
     # Base64 encode the binary data
     img_base64 = base64.b64encode(img_bytes).decode('utf-8')
 
@@ -41,28 +220,124 @@ def plpng(fig):
     return f'<img src="data:image/png;base64,{img_base64}">'
 
 
+@cpp.traced("convert")
+def plpng(fig):
+    """Convert a plotly figure (or raw dict figure) to a PNG image embedded in a data URI"""
+    # Get binary PNG data without trying to decode it (from the image cache if enabled)
+    fig_dict = _prepare_raw_figure(fig) if is_raw_figure(fig) else fig.to_dict()
+    return _png_img(cpi.to_image(fig_dict, format='png'))
+
+
+@cpp.traced("convert")
+def plpng_many(figs, workers=None, timeout=None):
+    """
+    Convert a list of plotly figures (or raw dict figures) to PNG images embedded in data URIs.
+    Figures are rendered in this process unless workers is given, then concurrently in the
+    long lived renderer pool (see commodplotimage)
+    :param figs:
+    :param workers: number of renderer processes, default commodplotimage.default_image_workers (in process)
+    :param timeout: seconds to wait for any one figure, default commodplotimage.default_image_timeout
+    :return: list of img tags
+    """
+    return [_png_img(img) for img in _png_bytes_many(figs, workers=workers, timeout=timeout)]
+
+
+def _image_fig_dicts(figs):
+    return [_prepare_raw_figure(f) if is_raw_figure(f) else f.to_dict() for f in figs]
+
+
+def _png_bytes_many(figs, workers=None, timeout=None):
+    return cpi.to_images(_image_fig_dicts(figs), workers=workers, timeout=timeout, format="png")
+
+
+async def _png_bytes_many_async(figs, workers=None, timeout=None):
+    fig_dicts = await asyncio.to_thread(_image_fig_dicts, figs)
+    return await cpi.to_images_async(fig_dicts, workers=workers, timeout=timeout, format="png")
+
+
+@cpp.traced("convert")
+async def convert_dict_plotly_fig_png_async(d, workers=None, timeout=None):
+    """
+    Async version of convert_dict_plotly_fig_png
+    """
+    found = _find_figures(d)
+    pngs = await _png_bytes_many_async([container[key] for container, key in found], workers=workers, timeout=timeout)
+    for (container, key), img in zip(found, pngs):
+        container[key] = _png_img(img)
+
+    return d
+
+
+@cpp.traced("convert")
+async def convert_dict_plotly_fig_cid_async(d, images=None, workers=None, timeout=None):
+    """
+    Async version of convert_dict_plotly_fig_cid
+    """
+    images = {} if images is None else images
+    found = _find_figures(d)
+    pngs = await _png_bytes_many_async([container[key] for container, key in found], workers=workers, timeout=timeout)
+    for (container, key), img in zip(found, pngs):
+        content_id = image_content_id(img)
+        images[content_id] = img
+        container[key] = f'<img src="cid:{content_id}">'
+
+    return d
+
+
+def image_content_id(img_bytes):
+    """Content id for an image, the same for identical images"""
+    return "chart-{}".format(hashlib.sha1(img_bytes).hexdigest()[:20])
 
+
+@cpp.traced("convert")
+def convert_dict_plotly_fig_cid(d, images=None, workers=None, timeout=None):
+    """
+    Given a dict (that might be passed to jinja), convert all plotly figures to img tags
+    referencing a cid: content id, for emails. The PNG bytes are added to images
+    (content id -> bytes, see messaging.EmailBuilder.attached_images) and identical
+    images share one content id so are only attached once.
+    :param d:
+    :param images: dict to add the images to
+    :return: d
+    """
+    images = {} if images is None else images
+    found = _find_figures(d)
+    pngs = _png_bytes_many([container[key] for container, key in found], workers=workers, timeout=timeout)
+    for (container, key), img in zip(found, pngs):
+        content_id = image_content_id(img)
+        images[content_id] = img
+        container[key] = f'<img src="cid:{content_id}">'
+
+    return d
+
+
+
+@cpp.traced("convert")
 def convert_dict_plotly_fig_html_div(d, interactive=True):
     """
     Given a dict (that might be passed to jinja), convert all plotly figures to html divs
     or png images depending on the interactive flag.
     """
     for k, v in d.items():
-        if isinstance(d[k], go.Figure):
+        if is_figure(d[k]):
             d[k] = plhtml(d[k], interactive=interactive)
         if isinstance(d[k], dict):
             convert_dict_plotly_fig_html_div(d[k], interactive=interactive)
         if isinstance(d[k], list):
             for count, item in enumerate(d[k]):
-                if isinstance(item, go.Figure):
+                if is_figure(item):
                     d[k][count] = plhtml(item, interactive=interactive)
     return d
 
 
-def plhtml(fig, interactive=True, margin=narrow_margin, **kwargs):
+@cpp.traced("convert")
+def plhtml(fig, interactive=True, margin=narrow_margin, encoding=None, render=None, **kwargs):
     """
     Given a plotly figure, return it as a div if interactive is True,
     or as a static png image if interactive is False.
+    Raw dict figures are rendered without being validated.
+    encoding is 'json' or 'binary' (see html_encodings), defaulting to default_html_encoding.
+    render is 'eager' or 'lazy' (see html_render_modes), defaulting to default_html_render.
 
     Note: Plotly.js is loaded once in base.html, so we set include_plotlyjs=False
     to avoid duplicate script tags (which can add megabytes to page size).
@@ -70,23 +345,341 @@ def plhtml(fig, interactive=True, margin=narrow_margin, **kwargs):
     if fig is None:
         return ""
 
+    encoding = encoding or default_html_encoding
+    if encoding not in html_encodings:
+        raise ValueError(
+            "Unknown html encoding '{}', expected one of {}".format(encoding, html_encodings)
+        )
+    render = render or default_html_render
+    if render not in html_render_modes:
+        raise ValueError(
+            "Unknown html render mode '{}', expected one of {}".format(render, html_render_modes)
+        )
+
+    if is_raw_figure(fig):
+        fig = _prepare_raw_figure(fig, margin=margin)
+        if not interactive:
+            return plpng(fig)
+        if render == "lazy" or encoding == "binary":
+            return _html_div(fig, encoding, render)
+        return pl.offline.plot(
+            fig,
+            include_plotlyjs=False,
+            output_type="div",
+            config=plhtml_config,
+            validate=False,
+        )
+
     fig.update_layout(margin=margin)
     fig.update_xaxes(automargin=True)
     fig.update_yaxes(automargin=True)
 
     if interactive:
-        # Optimized config to reduce HTML size and improve performance
-        config = {
-            'responsive': True,      # Auto-resize with container
-            'displaylogo': False,    # Remove Plotly logo
-            'modeBarButtonsToRemove': ['lasso2d', 'select2d'],  # Remove unused tools
-        }
+        if render == "lazy" or encoding == "binary":
+            return _html_div(fig.to_dict(), encoding, render)
         # Don't include plotlyjs - it's already loaded in base.html
-        return pl.offline.plot(fig, include_plotlyjs=False, output_type="div", config=config)
+        return pl.offline.plot(fig, include_plotlyjs=False, output_type="div", config=plhtml_config)
     else:
         return plpng(fig)
 
 
+def _date_spec(values):
+    """
+    datetime64 array as a plotly.js typed array spec of ms since epoch (NaT as NaN)
+    """
+    ms = values.astype("datetime64[ms]")
+    res = ms.astype(np.int64).astype("<f8")
+    res[np.isnat(ms)] = np.nan
+    return {"dtype": "f8", "bdata": base64.b64encode(res.tobytes()).decode("ascii")}
+
+
+def encode_figure_binary(fig_dict):
+    """
+    Rewrite a figure dict (from Figure.to_dict or _prepare_raw_figure) for the binary encoding:
+    datetime x/y arrays become typed arrays on axes forced to type 'date', and arrays
+    which appear in more than one trace are moved out to a shared list.
+    :param fig_dict:
+    :return: data, layout, list of shared array json and list of (trace, key, shared pos) refs
+    """
+    data = fig_dict["data"]
+    layout = dict(fig_dict.get("layout", {}))
+
+    seen = {}
+    for i, trace in enumerate(data):
+        for key, value in list(trace.items()):
+            if isinstance(value, np.ndarray) and value.dtype.kind == "M" and key in ("x", "y"):
+                ref = trace.get(key + "axis", key)
+                axis = key + "axis" + ref[1:]
+                axis_type = layout.get(axis, {}).get("type")
+                if axis_type in (None, "date"):
+                    layout[axis] = dict(layout.get(axis, {}), type="date")
+                    trace[key] = value = _date_spec(value)
+
+            if isinstance(value, (np.ndarray, list)) or (isinstance(value, dict) and "bdata" in value):
+                js = to_json_plotly(value)
+                if len(js) >= shared_array_min_size:
+                    seen.setdefault(js, []).append((i, key))
+
+    shared, refs = [], []
+    for js, uses in seen.items():
+        if len(uses) < 2:
+            continue
+        for i, key in uses:
+            del data[i][key]
+            refs.append((i, key, len(shared)))
+        shared.append(js)
+
+    return data, layout, shared, refs
+
+
+def _figure_payload(fig_dict, encoding):
+    """
+    Json for the data and layout of a figure dict, plus the shared arrays and refs
+    used by the binary encoding (empty for json)
+    """
+    if encoding == "binary":
+        data, layout, shared, refs = encode_figure_binary(fig_dict)
+    else:
+        data, layout, shared, refs = fig_dict["data"], fig_dict.get("layout", {}), [], []
+    return to_json_plotly(data), to_json_plotly(layout), shared, refs
+
+
+def _plotly_div(fig_dict, config, encoding):
+    """
+    Plotly div drawn as the page loads, laid out like
+    plotly.offline.plot(..., include_plotlyjs=False, output_type='div')
+    """
+    data, layout, shared, refs = _figure_payload(fig_dict, encoding)
+    plotdivid = str(uuid.uuid4())
+    return (
+        '<div style="height:100%; width:100%;">'
+        '<div id="{id}" class="plotly-graph-div" style="height:100%; width:100%;"></div>'
+        "<script>"
+        "window.PLOTLYENV=window.PLOTLYENV || {{}};"
+        'if (document.getElementById("{id}")) {{'
+        "var s=[{shared}];var d={data};"
+        "{refs}.forEach(function(r){{d[r[0]][r[1]]=s[r[2]];}});"
+        'Plotly.newPlot("{id}",d,{layout},{config});'
+        "}};"
+        "</script></div>"
+    ).format(
+        id=plotdivid,
+        shared=",".join(shared),
+        data=data,
+        refs=json.dumps(refs, separators=(",", ":")),
+        layout=layout,
+        config=json.dumps(config),
+    )
+
+
+def _lazy_div(fig_dict, config, encoding):
+    """
+    Placeholder div plus the figure json in an inert script block, drawn by the
+    loader in base.html once the placeholder scrolls into view. The placeholder
+    keeps the figure height so the page doesn't jump as charts are drawn.
+    """
+    data, layout, shared, refs = _figure_payload(fig_dict, encoding)
+    plotdivid = str(uuid.uuid4())
+    height = fig_dict.get("layout", {}).get("height") or lazy_placeholder_height
+    return (
+        '<div class="plotly-lazy" data-plotly-id="{id}" style="min-height:{height}px; width:100%;">'
+        '<div id="{id}" class="plotly-graph-div" style="height:100%; width:100%;"></div>'
+        '<script type="application/json" id="{id}-fig">'
+        '{{"data":{data},"layout":{layout},"config":{config},"shared":[{shared}],"refs":{refs}}}'
+        "</script></div>"
+    ).format(
+        id=plotdivid,
+        height=int(height),
+        data=data,
+        layout=layout,
+        config=json.dumps(config),
+        shared=",".join(shared),
+        refs=json.dumps(refs, separators=(",", ":")),
+    )
+
+
+def _html_div(fig_dict, encoding, render):
+    if render == "lazy":
+        return _lazy_div(fig_dict, plhtml_config, encoding)
+    return _plotly_div(fig_dict, plhtml_config, encoding)
+
+
+def _bytecode_cache(directory):
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:  # eg read-only home, compile in memory only
+        logging.warning("Template bytecode cache disabled, cannot create {}: {}".format(directory, e))
+        return None
+    return FileSystemBytecodeCache(directory)
+
+
+def get_environment(package_loader_name=None, template_dir=None, auto_reload=None, bytecode_cache_dir=None):
+    """
+    Jinja environment for a package's or directory's templates, falling back to the
+    commodplot templates. Environments are created once per configuration and reused.
+    :param package_loader_name: package with a templates directory
+    :param template_dir: directory of templates, if not using a package
+    :param auto_reload: recompile templates whose files changed, default default_template_auto_reload
+    :param bytecode_cache_dir: directory to store compiled templates in, default default_template_cache_dir
+        (none unless set), False to not use one
+    :return: jinja2.Environment
+    """
+    if auto_reload is None:
+        auto_reload = default_template_auto_reload
+    if bytecode_cache_dir is None:
+        bytecode_cache_dir = default_template_cache_dir
+
+    key = (package_loader_name, template_dir, auto_reload, bytecode_cache_dir)
+    with _environments_lock:
+        env = _environments.get(key)
+        if env is not None:
+            _environments.move_to_end(key)
+            return env
+
+        if package_loader_name:
+            # Use a ChoiceLoader to allow inheritance from both the specified package and commodplot
+            loader = ChoiceLoader([
+                PackageLoader(package_loader_name, "templates"),  # Project templates first
+                PackageLoader('commodplot', 'templates')  # Fall back to commodplot templates
+            ])
+        else:
+            # Use a ChoiceLoader to allow inheritance from both commodplot and local templates
+            loader = ChoiceLoader([
+                FileSystemLoader(template_dir),  # Local templates first
+                PackageLoader('commodplot', 'templates')  # Fall back to commodplot templates
+            ])
+
+        env = Environment(
+            loader=loader,
+            auto_reload=auto_reload,
+            bytecode_cache=_bytecode_cache(bytecode_cache_dir) if bytecode_cache_dir else None,
+            finalize=jinja_finalize,
+        )
+        # used by the data_table/virtual_table macros
+        env.globals.update(
+            table_id=cptab.table_id,
+            table_css=cptab.table_css,
+            table_payload_json=cptab.table_payload_json,
+        )
+        _environments[key] = env
+        while len(_environments) > max_environments:
+            _environments.popitem(last=False)
+        return env
+
+
+def clear_environments():
+    """
+    Drop the cached jinja environments (and their compiled templates held in memory)
+    """
+    with _environments_lock:
+        _environments.clear()
+
+
+def figure_trace_types(d):
+    """
+    Set of the trace types of all plotly figures in a dict (that might be passed to jinja)
+    """
+    types = set()
+    for container, key in _find_figures(d):
+        fig = container[key]
+        traces = fig["data"] if is_raw_figure(fig) else fig.data
+        types.update((trace.get("type") if isinstance(trace, dict) else trace.type) or "scatter" for trace in traces)
+    return types
+
+
+def plotlyjs_bundle(trace_types):
+    """
+    Name of the smallest plotly.js bundle that can draw the given trace types, None for the full bundle
+    """
+    for name, bundle_types in plotlyjs_bundles:
+        if set(trace_types) <= bundle_types:
+            return name
+
+
+def _plotlyjs_filename(bundle):
+    return "plotly-{}{}.min.js".format(bundle + "-" if bundle else "", plotlyjs_version)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_plotlyjs(bundle, directory):
+    # the smallest vendored bundle that covers the requested one
+    names = [name for name, _ in plotlyjs_bundles]
+    candidates = names[names.index(bundle):] if bundle else []
+    for name in candidates + [None]:
+        path = os.path.join(directory, _plotlyjs_filename(name)) if directory else None
+        if path and os.path.exists(path):
+            with open(path, encoding="utf8") as fh:
+                return fh.read()
+    if pl.offline.get_plotlyjs_version() == plotlyjs_version:
+        return pl.offline.get_plotlyjs()
+    raise FileNotFoundError(
+        "plotly.js {} not found in plotlyjs_dir ({}) and the plotly package ships {}, "
+        "download {} there or set $COMMODPLOT_PLOTLYJS_DIR".format(
+            plotlyjs_version, directory, pl.offline.get_plotlyjs_version(), _plotlyjs_filename(None)
+        )
+    )
+
+
+def plotlyjs_context(trace_types, plotlyjs=None):
+    """
+    Template variables for base.html to load plotly.js
+    :param trace_types: trace types the page draws (see figure_trace_types), empty if unknown
+    :param plotlyjs: 'cdn' or 'inline' (see plotlyjs_modes), default default_plotlyjs
+    :return: dict with plotlyjs_src or plotlyjs_inline
+    """
+    plotlyjs = plotlyjs or default_plotlyjs
+    if plotlyjs not in plotlyjs_modes:
+        raise ValueError("Unknown plotlyjs '{}', expected one of {}".format(plotlyjs, plotlyjs_modes))
+
+    # without figures in the data (eg divs made by the caller) we can't tell what is needed
+    bundle = plotlyjs_bundle(trace_types) if trace_types else None
+    if plotlyjs == "inline":
+        return {"plotlyjs_inline": _read_plotlyjs(bundle, plotlyjs_dir)}
+    return {"plotlyjs_src": "https://cdn.plot.ly/" + _plotlyjs_filename(bundle)}
+
+
+def _get_template(template, package_loader_name=None, auto_reload=None):
+    if package_loader_name:
+        tfilename = template  # When using PackageLoader, template is just the name
+        env = get_environment(package_loader_name=package_loader_name, auto_reload=auto_reload)
+    else:
+        tdirname, tfilename = os.path.split(os.path.abspath(template))
+        env = get_environment(template_dir=tdirname, auto_reload=auto_reload)
+
+    try:
+        return env.get_template(tfilename)
+    except Exception as e:
+        logging.error(f"Template '{tfilename}' not found. Available templates: {env.list_templates()[:10]}")
+        raise
+
+
+def _set_run_time(data):
+    # shown by the report_metadata macro: seconds since tracing started, ie the build so far
+    tracer = cpp.get_tracer()
+    if tracer is not None and "run_time" not in data:
+        data["run_time"] = round(tracer.elapsed(), 1)
+
+
+def _page_plotlyjs(data, plotlyjs=None, infer_plotlyjs_bundle=None):
+    if infer_plotlyjs_bundle is None:
+        infer_plotlyjs_bundle = default_infer_plotlyjs_bundle
+    return plotlyjs_context(figure_trace_types(data) if infer_plotlyjs_bundle else None, plotlyjs)
+
+
+def _template_context(data, template_globals=None, plotlyjs=None):
+    # template_globals are passed in the context rather than set on template.globals
+    # as the template object is shared by every render using its environment
+    context = dict(plotlyjs or {})
+    context.update(template_globals or {})
+    context.update(
+        pagetitle=data.get("name", ""),  # Make name optional
+        last_gen_time=datetime.now(),
+        data=data,
+    )
+    return context
+
+
+@cpp.traced("render")
 def render_html(
     data,
     template,
@@ -94,6 +687,9 @@ def render_html(
     template_globals=None,
     plotly_image_conv_func=convert_dict_plotly_fig_html_div,
     filename: str = None,
+    auto_reload=None,
+    plotlyjs=None,
+    infer_plotlyjs_bundle=None,
 ):
     """
     Using a Jinja2 template, render html file and return as string
@@ -103,49 +699,25 @@ def render_html(
     :param template_globals: dict of global variables to add to template context
     :param plotly_image_conv_func: function to convert plotly figures in data dict
     :param filename: if provided, save rendered output to this file
+    :param auto_reload: check templates for changes on each render, default default_template_auto_reload
+    :param plotlyjs: 'cdn' or 'inline' plotly.js, default default_plotlyjs
+    :param infer_plotlyjs_bundle: load the smallest plotly.js bundle for the trace types of the
+        figures in data rather than the full one, default default_infer_plotlyjs_bundle
     :return: rendered HTML string
     """
+    plotlyjs = _page_plotlyjs(data, plotlyjs, infer_plotlyjs_bundle)
     data = plotly_image_conv_func(data)
+    return _render_html(data, template, package_loader_name, template_globals, filename, auto_reload, plotlyjs)
 
-    # Handle template path/name based on loader type
-    from jinja2 import ChoiceLoader
-    
-    if package_loader_name:
-        # Use a ChoiceLoader to allow inheritance from both the specified package and commodplot
-        loader = ChoiceLoader([
-            PackageLoader(package_loader_name, "templates"),  # Project templates first
-            PackageLoader('commodplot', 'templates')  # Fall back to commodplot templates
-        ])
-        tfilename = template  # When using PackageLoader, template is just the name
-    else:
-        # Use a ChoiceLoader to allow inheritance from both commodplot and local templates
-        tdirname, tfilename = os.path.split(os.path.abspath(template))
-        loader = ChoiceLoader([
-            FileSystemLoader(tdirname),  # Local templates first
-            PackageLoader('commodplot', 'templates')  # Fall back to commodplot templates
-        ])
-    
-    env = Environment(loader=loader)
-    env.finalize = jinja_finalize
-    
-    try:
-        template = env.get_template(tfilename)
-    except Exception as e:
-        logging.error(f"Template '{tfilename}' not found. Available templates: {env.list_templates()[:10]}")
-        raise
-    
-    if template_globals:
-        for template_global in template_globals:
-            template.globals[template_global] = template_globals[template_global]
+
+def _render_html(data, template, package_loader_name, template_globals, filename, auto_reload, plotlyjs):
+    _set_run_time(data)
+    template = _get_template(template, package_loader_name, auto_reload)
 
     try:
-        output = template.render(
-            pagetitle=data.get("name", ""),  # Make name optional
-            last_gen_time=datetime.now(),
-            data=data
-        )
+        output = template.render(_template_context(data, template_globals, plotlyjs))
     except Exception as e:
-        logging.error(f"Error rendering template '{tfilename}': {str(e)}")
+        logging.error(f"Error rendering template '{template.name}': {str(e)}")
         logging.debug(f"Available variables: pagetitle={data.get('name', '')}, data keys={list(data.keys())}")
         raise
 
@@ -155,6 +727,109 @@ def render_html(
     return output
 
 
+@cpp.traced("render")
+async def render_html_async(
+    data,
+    template,
+    package_loader_name=None,
+    template_globals=None,
+    plotly_image_conv_func=convert_dict_plotly_fig_html_div,
+    filename: str = None,
+    auto_reload=None,
+    plotlyjs=None,
+    infer_plotlyjs_bundle=None,
+):
+    """
+    Async version of render_html. plotly_image_conv_func can be a coroutine function
+    (eg convert_dict_plotly_fig_png_async) or a plain function, which is run in a thread,
+    as is the template rendering and writing of the file.
+    """
+    plotlyjs = _page_plotlyjs(data, plotlyjs, infer_plotlyjs_bundle)  # before the figures are converted
+    func = plotly_image_conv_func
+    while isinstance(func, functools.partial):
+        func = func.func
+    if asyncio.iscoroutinefunction(func):
+        data = await plotly_image_conv_func(data)
+    else:
+        data = await asyncio.to_thread(plotly_image_conv_func, data)
+
+    return await asyncio.to_thread(
+        _render_html, data, template, package_loader_name, template_globals, filename, auto_reload, plotlyjs
+    )
+
+
+class LazyFigureHtml:
+    """
+    Plotly figure that is only converted to its html div when the template outputs it,
+    so rendering doesn't hold the divs of every chart in memory at once
+    """
+
+    __slots__ = ("fig", "interactive")
+
+    def __init__(self, fig, interactive=True):
+        self.fig = fig
+        self.interactive = interactive
+
+    def __html__(self):  # so |safe and autoescaping use the div as is
+        return plhtml(self.fig, interactive=self.interactive)
+
+    __str__ = __html__
+
+
+@cpp.traced("convert")
+def convert_dict_plotly_fig_html_div_lazy(d, interactive=True):
+    """
+    Given a dict (that might be passed to jinja), wrap all plotly figures in LazyFigureHtml
+    """
+    for container, key in _find_figures(d):
+        container[key] = LazyFigureHtml(container[key], interactive=interactive)
+    return d
+
+
+@cpp.traced("render")
+def stream_html(
+    data,
+    template,
+    filename: str,
+    package_loader_name=None,
+    template_globals=None,
+    plotly_image_conv_func=convert_dict_plotly_fig_html_div_lazy,
+    auto_reload=None,
+    plotlyjs=None,
+    infer_plotlyjs_bundle=None,
+):
+    """
+    Render a Jinja2 template straight to a file, writing the output as the template
+    produces it rather than building the whole page as a string first. Plotly figures
+    are converted to divs as the template reaches them. Use for large reports.
+    :param data: dict of jinja parameters to include in rendered html
+    :param template: absolute location of template file OR template name when using package loader
+    :param filename: location of where rendered html file should be output
+    :param package_loader_name: if using PackageLoader instead of FileLoader specify package name
+    :param template_globals: dict of global variables to add to template context
+    :param plotly_image_conv_func: function to convert plotly figures in data dict
+    :param auto_reload: check templates for changes on each render, default default_template_auto_reload
+    :param plotlyjs: 'cdn' or 'inline' plotly.js, default default_plotlyjs
+    :param infer_plotlyjs_bundle: load the smallest plotly.js bundle for the figures in data,
+        default default_infer_plotlyjs_bundle
+    :return: filename
+    """
+    plotlyjs = _page_plotlyjs(data, plotlyjs, infer_plotlyjs_bundle)
+    data = plotly_image_conv_func(data)
+    _set_run_time(data)
+    template = _get_template(template, package_loader_name, auto_reload)
+
+    logging.info("Writing html to {}".format(filename))
+    try:
+        with open(filename, "w", encoding="utf8") as fh:
+            template.stream(_template_context(data, template_globals, plotlyjs)).dump(fh)
+    except Exception as e:
+        logging.error(f"Error rendering template '{template.name}': {str(e)}")
+        raise
+
+    return filename
+
+
 def render_html_to_file(filename: str, output: str):
     """
     Using a Jinja2 template, render a html file and save to disk
@@ -181,6 +856,6 @@ def jinja_finalize(value):
     """
     if value is None:
         return ""
-    if isinstance(value, go.Figure):
+    if is_figure(value):
         return plhtml(value)
     return value
@@ -1,5 +1,9 @@
+import asyncio
+import concurrent.futures
+import functools
 import io
 import logging
+import threading
 import traceback
 from email.mime.application import MIMEApplication
 from email.mime.image import MIMEImage
@@ -8,19 +12,27 @@ from email.mime.text import MIMEText
 from email.utils import make_msgid
 from os import environ
 from pathlib import Path
-from smtplib import SMTP, SMTPException
+from smtplib import SMTP, SMTPException, SMTPResponseException, SMTPServerDisconnected
 from typing import Union
 
+from commodplot import commodplotprofile as cpp
 from commodplot import jinjautils
 
 logger = logging.getLogger(__name__)
 
+# how compose_and_send_jinja_report puts charts in the email
+#   datauri - png embedded in the html as base64 data URIs
+#   cid     - png attached once per distinct image and referenced with cid: URIs
+default_image_mode = "datauri"
+image_modes = ("datauri", "cid")
+
 
 class EmailBuilder:
     """Easily compose multipart e-mail messages, set headers and add attachments."""
 
     def __init__(self):
         self.message = MIMEMultipart()
+        self._related = None  # multipart/related part holding the html body and its inline images
 
     def set_sender(self, email: str):
         self.message["From"] = email
@@ -42,9 +54,30 @@ class EmailBuilder:
         return self
 
     def set_body(self, body: str, content_type: str = "html"):
-        self.message.attach(MIMEText(body, content_type))
+        part = MIMEText(body, content_type)
+        if content_type == "html" and self._related is not None:  # images were attached first
+            self._related.get_payload().insert(0, part)
+        else:
+            self.message.attach(part)
         return self
 
+    def _related_part(self):
+        """
+        Inline images go in a multipart/related part with the html body (mixed -> related ->
+        html + images) so mail clients show them in the body rather than as attachments
+        """
+        if self._related is None:
+            self._related = MIMEMultipart("related")
+            parts = self.message.get_payload()
+            for i, part in enumerate(parts):
+                if part.get_content_type() == "text/html":
+                    self._related.attach(part)
+                    parts[i] = self._related
+                    break
+            else:
+                self.message.attach(self._related)
+        return self._related
+
     def attach_file(
         self, file_name: str, attachment_name: str = None, content_id: str = None
     ):
@@ -71,16 +104,17 @@ class EmailBuilder:
         part = MIMEImage(image)
         part.add_header("Content-ID", f"<{content_id}>")
         part.add_header("Content-Disposition", f"inline; filename={content_id}")
-        self.message.attach(part)
+        self._related_part().attach(part)
         return self
 
     def attached_images(self, images: dict):
         """Attached multiple images to message"""
+        related = self._related_part()
         for content_id, image in images.items():
             part = MIMEImage(image)
             part.add_header("Content-ID", f"<{content_id}>")
             part.add_header("Content-Disposition", f"inline; filename={content_id}")
-            self.message.attach(part)
+            related.attach(part)
         return self
 
     def build(self) -> str:
@@ -88,15 +122,198 @@ class EmailBuilder:
         return self.message.as_string()
 
 
+class SMTPSender:
+    """
+    Send many messages over long lived SMTP connections rather than connecting
+    (and doing starttls/login) for every message. Each sending thread keeps its own
+    connection, send_many uses up to `connections` of them concurrently, and a
+    dropped connection is reopened and the message retried.
+
+    Configuration defaults to the same environment variables as compose_and_send_report.
+    """
+
+    def __init__(
+        self,
+        host: str = None,
+        port: int = None,
+        timeout: int = None,
+        starttls: bool = True,
+        username: str = None,
+        password: str = None,
+        connections: int = 1,
+        retries: int = 1,
+    ):
+        self.host = host or environ.get("SMTP_HOST")
+        self.port = port or int(environ.get("SMTP_PORT", "25"))
+        self.timeout = timeout or int(environ.get("SMTP_TIMEOUT", "60"))
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.retries = retries
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self) -> SMTP:
+        client = SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            client.starttls()
+        if self.username:
+            client.login(self.username, self.password)
+        return client
+
+    def _client(self) -> SMTP:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._connect()
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def _drop(self):
+        client = getattr(self._local, "client", None)
+        self._local.client = None
+        if client is not None:
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def send(self, sender_email: str, recipients: list, message: str) -> None:
+        """
+        Send one built message (see compose_report) on this thread's connection,
+        reconnecting and retrying if the connection has gone away
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._client().sendmail(sender_email, recipients, message)
+                return
+            except (SMTPServerDisconnected, ConnectionError, TimeoutError) as ex:
+                error = ex
+            except SMTPResponseException as ex:
+                if ex.smtp_code != 421:  # service closing channel
+                    raise
+                error = ex
+            self._drop()
+            logger.warning("SMTP connection lost (%s), reconnecting", error)
+        raise error
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.connections
+                )
+            return self._executor
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Run func on one of the sending threads (so it uses that thread's connection)
+        """
+        return self._get_executor().submit(func, *args, **kwargs)
+
+    async def send_async(self, sender_email: str, recipients: list, message: str) -> None:
+        """
+        Async version of send, using one of the `connections` sending threads
+        """
+        await asyncio.wrap_future(self.submit(self.send, sender_email, recipients, message))
+
+    def send_many(self, messages) -> list:
+        """
+        Send built messages concurrently over up to `connections` connections
+        :param messages: iterable of (sender_email, recipients, message) as returned by compose_report
+        :return: list of None (sent) or the exception raised for each message
+        """
+        executor = self._get_executor()
+        futures = [executor.submit(self.send, *message) for message in messages]
+        results = []
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                logger.error("Failed to send a report: %s", error)
+            results.append(error)
+        return results
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            try:
+                client.quit()
+            except Exception:
+                client.close()
+        self._local = threading.local()
+
+
+def _recipient_list(receiver_email) -> list:
+    # Handle semicolon-separated email addresses (convert to list for SMTP compatibility)
+    if isinstance(receiver_email, str):
+        if ';' in receiver_email:
+            return [email.strip() for email in receiver_email.split(';') if email.strip()]
+        elif ',' in receiver_email:
+            return [email.strip() for email in receiver_email.split(',') if email.strip()]
+        else:
+            return [receiver_email.strip()]
+    # Already a list
+    return receiver_email
+
+
+@cpp.traced("compose")
+def compose_report(
+    subject: str,
+    content: str,
+    images: dict = None,
+    sender_email: str = None,
+    receiver_email: str = None,
+) -> tuple:
+    """
+    Build a report e-mail message without sending it
+    :return: (sender_email, recipient list, message text) as taken by SMTPSender.send
+    """
+    if not sender_email:
+        sender_email = environ.get("SENDER_EMAIL")
+    if not receiver_email:
+        receiver_email = environ.get("RECEIVER_EMAIL")
+    message = (
+        EmailBuilder()
+        .set_sender(sender_email)
+        .set_receiver(receiver_email)
+        .set_subject(subject)
+        .set_body(content)
+    )
+    if images:
+        message.attached_images(images=images)
+
+    return sender_email, _recipient_list(receiver_email), message.build()
+
+
+@cpp.traced("report")
 def compose_and_send_report(
     subject: str,
     content: str,
     images: dict = None,
     sender_email: str = None,
     receiver_email: str = None,
+    smtp: SMTPSender = None,
 ) -> None:
     """
     Compose an e-mail message containing the report and send.
+    Pass an SMTPSender as smtp to reuse its connection instead of opening a new one.
 
     Configuration:
     * ENV: SENDER_EMAIL - e mail address of the sender
@@ -105,46 +322,33 @@ def compose_and_send_report(
     * ENV: SMTP_PORT - port of the SMTP server (default: 25)
     * ENV: SMTP_TIMEOUT - timeout for SMTP operations (default: 60 seconds)
     """
+    sender_email, recipient_list, message = compose_report(
+        subject=subject,
+        content=content,
+        images=images,
+        sender_email=sender_email,
+        receiver_email=receiver_email,
+    )
+    _send_report(sender_email, recipient_list, message, smtp=smtp)
 
-    if not sender_email:
-        sender_email = environ.get("SENDER_EMAIL")
-    if not receiver_email:
-        receiver_email = environ.get("RECEIVER_EMAIL")
+
+@cpp.traced("send")
+def _send_report(sender_email: str, recipient_list: list, message: str, smtp: SMTPSender = None) -> None:
     smtp_host = environ.get("SMTP_HOST")
     smtp_port = int(environ.get("SMTP_PORT", "25"))
     smtp_timeout = int(environ.get("SMTP_TIMEOUT", "60"))
-    message = (
-        EmailBuilder()
-        .set_sender(sender_email)
-        .set_receiver(receiver_email)
-        .set_subject(subject)
-        .set_body(content)
-    )
-    if images:
-        message.attached_images(images=images)
+    logger.info("Sending report e-mail to %s", recipient_list)
 
-    message = message.build()
-    logger.info("Sending report e-mail to %s", receiver_email)
-    
-    # Handle semicolon-separated email addresses (convert to list for SMTP compatibility)
-    if isinstance(receiver_email, str):
-        if ';' in receiver_email:
-            recipient_list = [email.strip() for email in receiver_email.split(';') if email.strip()]
-        elif ',' in receiver_email:
-            recipient_list = [email.strip() for email in receiver_email.split(',') if email.strip()]
-        else:
-            recipient_list = [receiver_email.strip()]
-    else:
-        # Already a list
-        recipient_list = receiver_email
-    
     try:
-        with SMTP(smtp_host, smtp_port, timeout=smtp_timeout) as client:
-            # client.set_debuglevel(1)
-            client.connect(smtp_host, smtp_port)
-            client.starttls()
-            client.sendmail(sender_email, recipient_list, message)
-            client.close()
+        if smtp is not None:
+            smtp.send(sender_email, recipient_list, message)
+        else:
+            with SMTP(smtp_host, smtp_port, timeout=smtp_timeout) as client:
+                # client.set_debuglevel(1)
+                client.connect(smtp_host, smtp_port)
+                client.starttls()
+                client.sendmail(sender_email, recipient_list, message)
+                client.close()
         logger.info("Report sent successfully")
     except SMTPException as ex:
         logger.exception("Failed to send a report")
@@ -155,6 +359,37 @@ def compose_and_send_report(
         errors.close()
 
 
+@cpp.traced("report")
+async def compose_and_send_report_async(
+    subject: str,
+    content: str,
+    images: dict = None,
+    sender_email: str = None,
+    receiver_email: str = None,
+    smtp: SMTPSender = None,
+) -> None:
+    """
+    Async version of compose_and_send_report. The message is built in a thread and sent on
+    one of the SMTPSender threads if smtp is given (bounding concurrent connections),
+    otherwise on a new connection in a thread.
+    """
+    sender_email, recipient_list, message = await asyncio.to_thread(
+        compose_report,
+        subject=subject,
+        content=content,
+        images=images,
+        sender_email=sender_email,
+        receiver_email=receiver_email,
+    )
+    if smtp is not None:
+        await asyncio.wrap_future(
+            smtp.submit(_send_report, sender_email, recipient_list, message, smtp=smtp)
+        )
+    else:
+        await asyncio.to_thread(_send_report, sender_email, recipient_list, message)
+
+
+@cpp.traced("report")
 def compose_and_send_jinja_report(
     subject: str,
     data: dict,
@@ -163,17 +398,85 @@ def compose_and_send_jinja_report(
     sender_email: str = None,
     receiver_email: str = None,
     template_globals=None,
+    image_mode: str = None,
+    smtp: SMTPSender = None,
 ):
+    """
+    Render a jinja report with charts as png images and send it.
+    image_mode is 'datauri' or 'cid' (see image_modes), defaulting to default_image_mode.
+    """
+    image_mode = image_mode or default_image_mode
+    if image_mode not in image_modes:
+        raise ValueError(
+            "Unknown image mode '{}', expected one of {}".format(image_mode, image_modes)
+        )
+
+    images = {}
+    image_conv_func = jinjautils.convert_dict_plotly_fig_png
+    if image_mode == "cid":
+        image_conv_func = functools.partial(
+            jinjautils.convert_dict_plotly_fig_cid, images=images
+        )
+
     message = jinjautils.render_html(
         data=data,
         template=template,
         package_loader_name=package_loader_name,
-        plotly_image_conv_func=jinjautils.convert_dict_plotly_fig_png,
+        plotly_image_conv_func=image_conv_func,
         template_globals=template_globals,
     )
     compose_and_send_report(
         subject=subject,
         content=message,
+        images=images,
+        sender_email=sender_email,
+        receiver_email=receiver_email,
+        smtp=smtp,
+    )
+
+
+@cpp.traced("report")
+async def compose_and_send_jinja_report_async(
+    subject: str,
+    data: dict,
+    template: str,
+    package_loader_name: str = None,
+    sender_email: str = None,
+    receiver_email: str = None,
+    template_globals=None,
+    image_mode: str = None,
+    smtp: SMTPSender = None,
+):
+    """
+    Async version of compose_and_send_jinja_report: figures are rasterized in the renderer
+    pool and the template rendered and mail sent without blocking the event loop,
+    so many reports can be built and sent at once with asyncio.gather
+    """
+    image_mode = image_mode or default_image_mode
+    if image_mode not in image_modes:
+        raise ValueError(
+            "Unknown image mode '{}', expected one of {}".format(image_mode, image_modes)
+        )
+
+    images = {}
+    image_conv_func = jinjautils.convert_dict_plotly_fig_png_async
+    if image_mode == "cid":
+        image_conv_func = functools.partial(
+            jinjautils.convert_dict_plotly_fig_cid_async, images=images
+        )
+
+    message = await jinjautils.render_html_async(
+        data=data,
+        template=template,
+        package_loader_name=package_loader_name,
+        plotly_image_conv_func=image_conv_func,
+        template_globals=template_globals,
+    )
+    await compose_and_send_report_async(
+        subject=subject,
+        content=message,
+        images=images,
         sender_email=sender_email,
         receiver_email=receiver_email,
+        smtp=smtp,
     )
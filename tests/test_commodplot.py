@@ -1,7 +1,9 @@
 # python
 import os
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import pytest
 
 from commodutil import forwards
 from commodutil.forward.util import convert_contract_to_date
@@ -36,6 +38,17 @@ def test_seas_line_plot(cl_data):
     assert dot_line_dict.get("hoverinfo") == "y"
 
 
+def test_seas_line_plot_percentile_bands(cl_data):
+    cl = cl_data.dropna(how="all", axis=1)
+    res = commodplot.seas_line_plot(
+        cl[cl.columns[-1]], percentile_bands=[10, 25, 75, 90], percentile_range=[2022, 2024]
+    )
+    bands = [x for x in res.data if x["legendgroup"] in ("p10-p90", "p25-p75")]
+    assert [x.name for x in bands] == ["22-24 p90", "22-24 p10", "22-24 p75", "22-24 p25"]
+    assert [x.fill for x in bands] == [None, "tonexty", None, "tonexty"]
+    assert all((np.nan_to_num(x.y - y.y) >= 0).all() for x, y in zip(bands[::2], bands[1::2]))
+
+
 def test_seas_line_subplot():
     dr = pd.date_range(start="2015", end="2027-12-31", freq="B")
     data = {"A": [10 for _ in dr], "B": [20 for _ in dr], "C": [30 for _ in dr], "D": [10 for _ in dr]}
@@ -50,6 +63,13 @@ def test_seas_line_subplot():
     assert isinstance(res, go.Figure)
     assert [x.name for x in res.data].count("2020") == 4
 
+    # grid larger than the number of series, cells computed in a thread pool
+    res2 = commodplot.seas_line_subplot(
+        2, 3, df, fwd=fwd, shaded_range=5, max_workers=4
+    )
+    assert [x.name for x in res2.data] == [x.name for x in res.data]
+    assert [x.xaxis for x in res2.data][-1] == "x4"
+
 
 def test_reindex_year_line_plot(cl_data):
     cl = cl_data.dropna(how="all", axis=1)
@@ -60,6 +80,12 @@ def test_reindex_year_line_plot(cl_data):
     res = commodplot.reindex_year_line_plot(sp, max_results=360, visible_line_years=7)
     assert isinstance(res, go.Figure)
 
+    res = commodplot.reindex_year_line_plot(sp, max_points=100)
+    assert all(len(x.x) <= 110 for x in res.data)
+
+    res = commodplot.reindex_year_line_plot(sp, percentile_bands=True, percentile_range=[2015, 2020])
+    assert len([x for x in res.data if x["legendgroup"] in ("p10-p90", "p25-p75")]) == 4
+
 
 def test_fwd_hist_plot():
     dirname = os.path.dirname(os.path.abspath(__file__))
@@ -72,6 +98,18 @@ def test_fwd_hist_plot():
     res = commodplot.forward_history_plot(cl)
     assert isinstance(res, go.Figure)
 
+    # snapshot labels are dd/mm/yyyy
+    res = commodplot.forward_history_plot(cl, dayfirst=True)
+    assert [x.name for x in res.data][:2] == ["08-Jun-21", "07-Jun-21"]
+    res = commodplot.forward_history_plot(cl, date_format="%d/%m/%Y")
+    assert [x.name for x in res.data][:2] == ["08-Jun-21", "07-Jun-21"]
+
+    res = commodplot.forward_history_plot(cl, dayfirst=True, decimate=((2, "D"), (None, "W")))
+    assert [x.name for x in res.data] == ["08-Jun-21", "07-Jun-21", "04-Jun-21", "28-May-21", "21-May-21"]
+
+    res = commodplot.forward_history_plot(cl, mode="heatmap")
+    assert len(res.data) == 1 and res.data[0].z.shape == (len(cl.columns), len(cl))
+
 
 def test_candle_chart():
     dirname = os.path.dirname(os.path.abspath(__file__))
@@ -84,6 +122,9 @@ def test_candle_chart():
     res = commodplot.candle_chart(cl)
     assert isinstance(res, go.Figure)
 
+    res = commodplot.candle_chart(cl, max_points=20)
+    assert len(res.data[0].x) == 20
+
 
 def test_stack_area_chart():
     dirname = os.path.dirname(os.path.abspath(__file__))
@@ -137,6 +178,27 @@ def test_table_plot(cl_data):
     cl = cl_data.dropna(how="all", axis=1)
     res = commodplot.table_plot(cl, formatted_cols=["CL_2020F"])
     assert isinstance(res, go.Figure)
+    assert isinstance(cl.index, pd.DatetimeIndex)  # caller's frame is left alone
+    colours = res.data[0].cells.font.color
+    assert list(colours[list(cl.columns).index("CL_2020F") + 1]) == ["red" if x < 0 else "green" for x in cl["CL_2020F"]]
+
+    res = commodplot.table_plot(cl, page_size=100, page=-1)
+    assert len(res.data[0].cells.values[0]) == (len(cl) % 100 or 100)
+    assert res.data[0].cells.values[0][-1] == cl.index[-1].strftime("%d-%m-%Y")
+
+    raw = commodplot.table_plot(cl, page_size=100, page=-1, raw=True)
+    assert list(raw["data"][0]["cells"]["values"][0]) == list(res.data[0].cells.values[0])
+
+    with pytest.raises(ValueError, match="pages 0 to"):
+        commodplot.table_plot(cl, page_size=100, page=len(cl) // 100 + 1)
+
+    # nullable columns with NA
+    nullable = pd.DataFrame({"A": pd.array([1, None, -3], dtype="Int64"), "B": pd.array([-1.5, 2, None], dtype="Float64")})
+    for raw in (False, True):
+        res = commodplot.table_plot(nullable, formatted_cols=["A", "B"], raw=raw)
+        cells = res["data"][0]["cells"] if raw else res.data[0].cells
+        assert list(cells["font"]["color"][1]) == ["green", "green", "red"]
+        assert list(cells["font"]["color"][2]) == ["red", "green", "green"]
 
 
 def test_seas_table(cl_data):
@@ -145,6 +207,11 @@ def test_seas_table(cl_data):
     res = commodplot.seas_table_plot(cl[cl.columns[-1]], fwd)
     assert isinstance(res, go.Figure)
 
+    res = commodplot.seas_table_plot(cl[cl.columns[-3:]])
+    labels = res.data[0].cells.values[0]
+    assert len(labels) == 3 * 19
+    assert [x for x in labels if x] == list(cl.columns[-3:])
+
 
 def test_diff_plot(cl_data):
     cl = cl_data.dropna(how="all", axis=1)[["CL_2020F", "CL_2020G"]]
@@ -174,6 +241,10 @@ def test_line_plot2(cl_data):
     res = commodplot.line_plot(cl, fwd=fwd, title="Test")
     assert isinstance(res, go.Figure)
 
+    res = commodplot.line_plot(cl, fwd=fwd, title="Test", max_points=50)
+    assert all(len(x.x) <= 51 for x in res.data)
+    assert res.data[0].y[-1] == cl["A"].dropna().iloc[-1]
+
 
 def test_stacked_grouped_bar_chart():
     level1 = ["A", "A", "B", "B"]
@@ -202,4 +273,61 @@ def test_timeseries_scatter_plot(cl_data):
     cl = cl_data.dropna(how="all", axis=1)
     cl = cl[cl.columns[:2]].dropna()
     res = commodplot.timeseries_scatter_plot(cl, line_last_n=12, fit_line=True)
-    assert isinstance(res, go.Figure)
\ No newline at end of file
+    assert isinstance(res, go.Figure)
+
+def test_seas_line_plot_many(cl_data):
+    cl = cl_data.dropna(how="all", axis=1)
+    mapping = {x: cl[x] for x in cl.columns[-3:]}
+    mapping["weekly"] = cl[cl.columns[-1]].dropna().resample("W-FRI").last()
+    res = commodplot.seas_line_plot_many(mapping, shaded_range=2)
+    assert list(res) == list(mapping)
+    for name, fig in res.items():
+        single = commodplot.seas_line_plot(mapping[name], title=name, shaded_range=2)
+        assert [x.name for x in fig.data] == [x.name for x in single.data]
+        for trace, expected in zip(fig.data, single.data):
+            np.testing.assert_allclose(
+                np.asarray(trace.y, dtype=float), np.asarray(expected.y, dtype=float), equal_nan=True
+            )
+        assert fig.layout.title.text == single.layout.title.text
+
+    # raw mode carries over to the worker processes, whether asked for per call or by context
+    from commodplot import commodplottrace as cptr
+
+    res = commodplot.seas_line_plot_many(mapping, processes=2, shaded_range=2, raw=True)
+    assert all(cptr.is_raw_figure(fig) for fig in res.values())
+    with cptr.raw_figures():
+        res = commodplot.seas_line_plot_many(mapping, processes=2, shaded_range=2)
+    assert all(cptr.is_raw_figure(fig) for fig in res.values())
+
+    # the native engine seasonalises each frequency group in one go, with the same values
+    res = commodplot.seas_line_plot_many(mapping, shaded_range=2, seas_engine="native")
+    for name, fig in res.items():
+        single = commodplot.seas_line_plot(mapping[name], title=name, shaded_range=2, seas_engine="native")
+        for trace, expected in zip(fig.data, single.data):
+            np.testing.assert_allclose(
+                np.asarray(trace.y, dtype=float), np.asarray(expected.y, dtype=float), equal_nan=True
+            )
+
+
+def test_seas_line_plot_raw(cl_data):
+    import json
+    from plotly.io.json import to_json_plotly
+    from commodplot import commodplottrace as cptr
+    from commodplot import jinjautils
+
+    cl = cl_data.dropna(how="all", axis=1)
+    kwargs = dict(shaded_range=2, average_line=2, title="Test")
+    fig = commodplot.seas_line_plot(cl[cl.columns[-1]], **kwargs)
+    raw = commodplot.seas_line_plot(cl[cl.columns[-1]], raw=True, **kwargs)
+    assert cptr.is_raw_figure(raw)
+    expected = json.loads(fig.to_json())
+    res = json.loads(to_json_plotly(jinjautils._prepare_raw_figure(raw)))
+    assert res["data"] == expected["data"]
+    assert res["layout"]["title"] == expected["layout"]["title"]
+    assert res["layout"]["template"] == expected["layout"]["template"]
+    assert isinstance(cptr.to_figure(raw), go.Figure)
+    assert "plotly-graph-div" in jinjautils.plhtml(raw)
+
+    with cptr.raw_figures():
+        assert cptr.is_raw_figure(commodplot.line_plot(cl[cl.columns[-2:]]))
+    assert isinstance(commodplot.line_plot(cl[cl.columns[-2:]]), go.Figure)
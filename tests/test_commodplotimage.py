@@ -0,0 +1,84 @@
+# python
+import json
+
+import plotly.graph_objects as go
+
+from commodplot import commodplotimage
+from commodplot import jinjautils
+
+
+def fake_renderer(fig, **opts):
+    return json.dumps([fig["data"][0]["name"], opts["format"]]).encode()
+
+
+def test_renderer_pool_keeps_order():
+    figs = [{"data": [{"type": "scatter", "name": str(i)}], "layout": {}} for i in range(6)]
+    with commodplotimage.RendererPool(workers=2, renderer=fake_renderer) as pool:
+        res = pool.to_images(figs)
+        workers = pool._pool
+        assert pool.to_images(figs[:1]) == res[:1]
+        assert pool._pool is workers  # workers are reused
+    assert [json.loads(x) for x in res] == [[str(i), "png"] for i in range(6)]
+    assert pool._pool is None
+
+
+def test_to_images_in_process_by_default(monkeypatch):
+    monkeypatch.setattr(commodplotimage, "render_image", fake_renderer)
+    monkeypatch.setattr(commodplotimage, "get_renderer_pool", None)  # would fail if the pool was used
+    figs = [{"data": [{"type": "scatter", "name": str(i)}], "layout": {}} for i in range(3)]
+    res = commodplotimage.to_images(figs, format="png")
+    assert [json.loads(x) for x in res] == [[str(i), "png"] for i in range(3)]
+    # a single figure isn't worth sending to the pool
+    assert commodplotimage.to_images(figs[:1], workers=4, format="png") == res[:1]
+
+
+def test_convert_dict_plotly_fig_png_batches(monkeypatch):
+    calls = []
+
+    def to_images(fig_dicts, **kwargs):
+        calls.append(len(fig_dicts))
+        return [b"png"] * len(fig_dicts)
+
+    monkeypatch.setattr(commodplotimage, "to_images", to_images)
+    fig = go.Figure(go.Bar(x=[1, 2], y=[1, 2]))
+    data = {"a": fig, "b": 1, "inner": {"c": fig}, "items": [fig, "x"]}
+    res = jinjautils.convert_dict_plotly_fig_png(data)
+    assert calls == [3]
+    assert res["a"] == res["inner"]["c"] == res["items"][0] == '<img src="data:image/png;base64,cG5n">'
+    assert res["items"][1] == "x"
+
+
+def test_image_cache(tmp_path, monkeypatch):
+    rendered = []
+
+    def render_image(fig_dict, **opts):
+        rendered.append(fig_dict["data"][0]["y"])
+        return b"img" * 100
+
+    monkeypatch.setattr(commodplotimage, "render_image", render_image)
+    cache = commodplotimage.enable_image_cache(directory=str(tmp_path), max_bytes=700)
+    try:
+        fig = go.Figure(go.Bar(x=[1, 2], y=[1, 2]))
+        assert jinjautils.plpng(fig) == jinjautils.plpng(go.Figure(fig))
+        assert len(rendered) == 1
+        assert commodplotimage.image_cache_info()["hits"] == 1
+        assert commodplotimage.image_cache_info()["misses"] == 1
+
+        # different options are a different entry
+        commodplotimage.to_image(fig.to_dict(), format="png", scale=2)
+        assert len(rendered) == 2
+
+        for i in range(3):  # 300 bytes each, so only two fit
+            commodplotimage.to_image(go.Figure(go.Bar(x=[1], y=[i + 10])).to_dict())
+        assert cache.info()["entries"] == 2
+        assert cache.info()["nbytes"] <= 700
+
+        # writing a key again replaces its size in the total
+        key = cache.key(fig.to_dict())
+        cache.put(key, b"x" * 100)
+        nbytes = cache.info()["nbytes"]
+        cache.put(key, b"x" * 50)
+        assert cache.info()["nbytes"] == nbytes - 50
+    finally:
+        commodplotimage.disable_image_cache()
+    assert commodplotimage.image_cache_info() is None
@@ -0,0 +1,30 @@
+# python
+import json
+
+from commodplot import commodplot
+from commodplot import commodplotprofile
+from commodplot import jinjautils
+
+
+def test_tracing(cl_data, tmp_path):
+    cl = cl_data.dropna(how="all", axis=1)
+    filename = tmp_path / "report.trace.json"
+
+    with commodplotprofile.tracing(str(filename)):
+        data = {"name": "test", "fig1": commodplot.seas_line_plot(cl[cl.columns[-1]])}
+        jinjautils.render_html(data, "test_report.html", package_loader_name="commodplot")
+    assert commodplotprofile.get_tracer() is None
+    assert isinstance(data["run_time"], float)
+
+    events = json.load(open(filename))["traceEvents"]
+    spans = {e["name"]: e for e in events if e["ph"] == "X"}
+    assert {"seas_line_plot", "seas_plot_traces", "convert_dict_plotly_fig_html_div", "plhtml", "render_html"} <= set(spans)
+    # seas_plot_traces runs inside seas_line_plot
+    outer, inner = spans["seas_line_plot"], spans["seas_plot_traces"]
+    assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+
+def test_tracing_off():
+    data = {"name": "test"}
+    jinjautils.render_html(data, "test_report.html", package_loader_name="commodplot")
+    assert "run_time" not in data
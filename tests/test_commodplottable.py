@@ -1,5 +1,9 @@
+import decimal
+import json
+import os
 import unittest
 
+import numpy as np
 import pandas as pd
 
 from commodplot import commodplottable as cpt
@@ -15,6 +19,81 @@ class TestCommodplotTable(unittest.TestCase):
         res = cpt.generate_table(df, accounting_col_columns=["Bar"])
         self.assertIn('<style type="text/css">', res)
 
+    def test_generate_table_engines(self):
+        df = pd.DataFrame(
+            {"Foo": [1234.5, -2.25], "Bar": [-1, 2], "Buzz": ["a", "b"]},
+            index=["First", "Second"],
+        )
+        for engine in cpt.table_engines:
+            res = cpt.generate_table(df, precision={"Foo": 2}, accounting_col_columns=["Foo", "Bar"], engine=engine)
+            self.assertIn("th.col_heading", res)
+            self.assertIn("1,234.50", res)
+            self.assertIn("-2.25", res)
+
+        res = cpt.generate_table(df, precision={"Foo": 2}, accounting_col_columns=["Foo", "Bar"], engine="html")
+        self.assertEqual(res.count('<td style="color: red" >'), 2)
+        self.assertIn('<td style="color: green" >2</td>', res)
+        self.assertIn("<td >a</td>", res)
+
+        with self.assertRaises(ValueError):
+            cpt.generate_table(df, engine="latex")
+
+    def test_generate_table_nullable(self):
+        df = pd.DataFrame({"Foo": pd.array([1234, None, -5], dtype="Int64")}, index=["First", "Second", "Third"])
+        res = cpt.generate_table(df, precision={"Foo": 1}, accounting_col_columns=["Foo"], engine="html")
+        self.assertIn("1,234.0", res)
+        self.assertIn("nan", res)
+        self.assertEqual(res.count('<td style="color: red" >'), 1)
+
+    def test_table_payload(self):
+        df = pd.DataFrame(
+            {"Foo": [1234.567, None], "Bar": ["</script>", "b"]},
+            index=pd.DatetimeIndex(["2024-01-01", "2024-01-02"], name="Date"),
+        )
+        res = cpt.table_payload(df, precision={"Foo": 2}, accounting_col_columns=["Foo"])
+        self.assertEqual(res["columns"], ["Date", "Foo", "Bar"])
+        self.assertEqual(res["values"][0], ["2024-01-01", "2024-01-02"])
+        self.assertEqual(res["values"][1], [1234.57, None])
+        self.assertEqual(res["formats"][1], {"decimals": 2, "thousands": True})
+        self.assertEqual(res["accounting"], [False, True, False])
+        self.assertNotIn("</script>", cpt.table_payload_json(df))
+
+    def test_table_payload_json_values(self):
+        df = pd.DataFrame(
+            {
+                "Foo": [1.5, np.inf, -np.inf],
+                "When": pd.Series([pd.Timestamp("2024-01-01"), None, pd.Timestamp("2024-01-03")], dtype=object),
+                "Price": [decimal.Decimal("1.25"), None, decimal.Decimal("3")],
+                "Count": pd.array([1, None, 3], dtype="Int64"),
+            }
+        )
+        res = json.loads(cpt.table_payload_json(df, precision={"Count": 0}))
+        self.assertEqual(res["values"][1], [1.5, None, None])
+        self.assertEqual(res["values"][2], ["2024-01-01", None, "2024-01-03"])
+        self.assertEqual(res["values"][3], ["1.25", None, "3"])
+        self.assertEqual(res["values"][4], [1.0, None, 3.0])
+
+    def test_data_table_macro(self):
+        import tempfile
+        from commodplot import jinjautils
+
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, "page.html")
+            with open(template, "w") as fh:
+                fh.write(
+                    '{% import "macros.html" as m %}{{ m.data_table(data.small) }}'
+                    '{{ m.data_table(data.big, css_class="report-table", virtual=True) }}'
+                )
+            big = pd.DataFrame({"Foo": range(2000)})
+            res = jinjautils.render_html({"small": big.head(), "big": big}, template)
+            static = jinjautils.render_html({"small": big, "big": big.head()}, template)
+
+        self.assertEqual(res.count('class="virtual-table"'), 1)
+        self.assertEqual(res.count("<td>"), 5)  # only the small table is written out
+        self.assertIn('class="report-table"', res)
+        # large frames stay static unless virtual=True is asked for
+        self.assertEqual(static.count("<td>"), 2000)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -23,4 +23,26 @@ def test_timeseries_trace_by_year(df_datetime):
     assert isinstance(t, go.Scatter)
     assert t.name == str(colyear)
     assert t.visible == cptr.line_visible(colyear)
-    assert t.line.color == cptr.get_year_line_col(colyear)
\ No newline at end of file
+    assert t.line.color == cptr.get_year_line_col(colyear)
+
+def test_seasonal_stats(df_datetime):
+    dft = transforms.seasonailse(df_datetime)
+    stats = cptr.SeasonalStats(dft, percentiles=[10, 90])
+    res, rangeyr = stats.stats(3)
+    assert list(res.columns) == ["min", "median", "max", "p10", "p90", "mean"]
+    assert rangeyr == 3
+    assert (res["min"] <= res["p10"]).all() and (res["p90"] <= res["max"]).all()
+    assert stats.stats(3)[0] is res  # calculated once per range
+
+    r = cptr.clean_seas_df_for_min_max_average(dft, 3)
+    pd.testing.assert_series_equal(res["mean"], r.mean(axis=1), check_names=False)
+
+
+def test_shaded_range_and_average_line_share_stats(df_datetime):
+    dft = transforms.seasonailse(df_datetime)
+    stats = cptr.SeasonalStats(dft)
+    traces = cptr.shaded_range_traces(stats, 5)
+    avg = cptr.average_line_trace(stats, 5)
+    assert len(traces) == 2
+    assert avg.name == "5yr Avg"
+    assert list(stats._results) == [5]
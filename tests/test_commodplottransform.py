@@ -0,0 +1,152 @@
+# python
+import numpy as np
+import pandas as pd
+import pytest
+from commodutil import transforms
+
+from commodplot import commodplottransform as cpt
+
+
+@pytest.mark.parametrize("freq", ["D", "B", "MS"])
+def test_seasonalise_native_parity(freq):
+    idx = pd.date_range("2011-03-05", "2025-08-30", freq=freq)
+    rng = np.random.default_rng(1)
+    s = pd.Series(rng.normal(size=len(idx)), index=idx, name="A")
+    s[rng.random(len(s)) < 0.05] = np.nan
+
+    expected = transforms.seasonalize(s, histfreq=freq)
+    res = cpt.seasonalise(s, histfreq=freq, engine="native")
+    pd.testing.assert_frame_equal(res, expected, check_index_type=False, check_freq=False)
+
+
+@pytest.mark.parametrize("freq", ["W-FRI", "W-MON"])
+def test_seasonalise_native_parity_weekly(freq):
+    idx = pd.date_range("2011-03-05", "2025-08-30", freq=freq).to_series()
+    idx.iloc[::7] = idx.iloc[::7] - pd.Timedelta(days=1)  # some off-weekday reports
+    s = pd.Series(np.arange(len(idx), dtype=float), index=pd.DatetimeIndex(idx.values))
+
+    expected = transforms.seasonalize(s, histfreq="W")
+    res = cpt.seasonalise(s, histfreq="W", engine="native")
+    pd.testing.assert_frame_equal(res, expected, check_index_type=False, check_freq=False)
+
+
+def test_seasonalise_native_leap_day(df_datetime):
+    res = cpt.seasonalise(df_datetime, histfreq="D", engine="native")
+    assert len(res) == 365
+    assert not ((res.index.month == 2) & (res.index.day == 29)).any()
+
+
+def test_seasonalise_unknown_engine(df_datetime):
+    with pytest.raises(ValueError):
+        cpt.seasonalise(df_datetime, histfreq="D", engine="foo")
+
+
+def test_seasonalise_cache(df_datetime):
+    cpt.enable_cache()
+    try:
+        res1 = cpt.seasonalise(df_datetime, histfreq="D")
+        res1.iloc[0, 0] = -999  # mutating the result must not affect the cache
+        res2 = cpt.seasonalise(df_datetime, histfreq="D")
+        assert res2.iloc[0, 0] != -999
+        assert cpt.cache_info()["hits"] == 1
+        assert cpt.cache_info()["misses"] == 1
+
+        cpt.seasonalise(df_datetime, histfreq="D", engine="native")  # different key
+        cpt.seasonalise(df_datetime * 2, histfreq="D")  # different data
+        assert cpt.cache_info()["misses"] == 3
+
+        cpt.clear_cache()
+        assert cpt.cache_info()["entries"] == 0
+    finally:
+        cpt.disable_cache()
+    assert cpt.cache_info() is None
+
+
+def test_reindex_year_cache_new_year(monkeypatch):
+    from commodutil import dates
+
+    df = pd.DataFrame(
+        {2020: [1.0, 2.0], 2021: [3.0, 4.0]}, index=pd.to_datetime(["2020-01-01", "2021-01-01"])
+    )
+    cpt.enable_cache()
+    try:
+        cpt.reindex_year(df)
+        cpt.reindex_year(df)
+        assert cpt.cache_info()["hits"] == 1
+        # a long running process crossing into a new year reindexes again
+        monkeypatch.setattr(dates, "curyear", dates.curyear + 1, raising=False)
+        cpt.reindex_year(df)
+        assert cpt.cache_info()["misses"] == 2
+    finally:
+        cpt.disable_cache()
+
+
+def test_frame_cache_evicts_by_size(df_datetime):
+    cache = cpt.FrameCache(max_bytes=int(df_datetime.memory_usage(deep=True).sum() * 2.5))
+    for i in range(4):
+        cache.put(i, df_datetime)
+    assert cache.info()["entries"] == 2
+    assert cache.get(0) is None
+    assert cache.get(3) is not None
+
+
+def _lttb_reference(x, y, max_points):
+    every = (len(x) - 2) / (max_points - 2)
+    a, res = 0, [0]
+    for i in range(max_points - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        if i == max_points - 3:
+            nx, ny = x[-1], y[-1]
+        else:
+            nxt = slice(end, min(int((i + 2) * every) + 1, len(x)))
+            nx, ny = x[nxt].mean(), y[nxt].mean()
+        area = np.abs((x[a] - nx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (ny - y[a]))
+        a = start + int(area.argmax())
+        res.append(a)
+    return np.array(res + [len(x) - 1])
+
+
+def test_lttb_matches_sequential():
+    y = np.random.default_rng(0).normal(size=5000).cumsum()
+    x = np.arange(len(y), dtype=float)
+    assert np.array_equal(cpt.lttb(x, y, 300), _lttb_reference(x, y, 300))
+
+
+def test_downsample_keeps_gaps_and_last(df_datetime):
+    s = df_datetime["A"].astype(float)
+    s.iloc[1000:1100] = np.nan
+    res = cpt.downsample(s, 500)
+    assert len(res) <= 501
+    assert res.index[-1] == s.index[-1] and res.iloc[-1] == s.iloc[-1]
+    assert res.isna().sum() == 1 and np.isnan(res[s.index[1000]])
+    assert res[s.index[999]] == s.iloc[999] and res[s.index[1100]] == s.iloc[1100]
+    assert cpt.downsample(s, None) is s
+
+
+def test_downsample_ohlc(df_datetime):
+    a = df_datetime["A"].astype(float)
+    df = pd.DataFrame({"Open": a, "High": a + 1, "Low": a - 1, "Close": a + 0.5})
+    res = cpt.downsample_ohlc(df, 100)
+    assert len(res) == 100
+    assert res["Close"].iloc[-1] == df["Close"].iloc[-1]
+    assert res["High"].max() == df["High"].max() and res["Low"].min() == df["Low"].min()
+
+
+def test_decimate_snapshots():
+    snapshots = pd.bdate_range(end="2025-06-30", periods=300)[::-1]
+    keep = snapshots[cpt.decimate_snapshots(snapshots)].sort_values()
+    # every day of the last week, then the last snapshot of each week and month
+    assert list(keep[-6:]) == list(snapshots[:6][::-1])
+    assert keep.max() == snapshots.max()
+    assert len(keep) < 40
+    old = keep[keep < snapshots.max() - pd.Timedelta(days=92)]
+    assert not old.to_period("M").duplicated().any()
+
+
+def test_snapshot_dates():
+    # one label that can only be day first doesn't change how the others are read
+    assert list(cpt.snapshot_dates(["01/02/2024", "03/04/2024"])) == [pd.Timestamp("2024-01-02"), pd.Timestamp("2024-03-04")]
+    assert cpt.snapshot_dates(["01/02/2024", "13/04/2024"])[0] == pd.Timestamp("2024-01-02")
+    expected = [pd.Timestamp("2024-02-01"), pd.Timestamp("2024-04-13")]
+    assert list(cpt.snapshot_dates(["01/02/2024", "13/04/2024"], dayfirst=True)) == expected
+    assert list(cpt.snapshot_dates(["01/02/2024", "13/04/2024"], format="%d/%m/%Y")) == expected
@@ -1,4 +1,5 @@
 # python
+import numpy as np
 import pandas as pd
 from commodplot import commodplotutil as cpu
 
@@ -26,4 +27,37 @@ def test_gen_title_with_title_and_postfix():
     df = pd.DataFrame([1, 2, 3], columns=["Test"])
     res = cpu.gen_title(df, title="TTitle", title_postfix="post")
     assert res.startswith("TTitle  post:")
-    assert res.endswith("+1")
\ No newline at end of file
+    assert res.endswith("+1")
+
+def test_strftime():
+    idx = pd.date_range("2019-12-25", "2024-03-05", freq="D")
+    for date_format in ["%d-%b", "%b", "%d-%b-%y"]:
+        res = cpu.strftime(idx, date_format)
+        assert list(res) == list(idx.strftime(date_format))
+
+
+def test_seas_table():
+    index = pd.date_range("2020-01-01", "2021-12-31", freq="D")
+    hist = pd.DataFrame({"A": index.month.astype(float), "B": -index.month.astype(float)}, index=index)
+
+    res = cpu.seas_table(hist["A"])
+    assert list(res.index) == cpu.seas_table_periods
+    assert list(res.columns) == [2020, 2021]
+    assert res.loc["Mar", 2020] == 3 and res.loc["Q2", 2021] == 5
+    assert res.loc["Q1+Q4", 2020] == 6.5 and res.loc["Year", 2021] == 6.5
+
+    # forward curve starting in the last month of history replaces it
+    fwd = pd.Series([100.0, 200.0], index=pd.date_range("2021-12-01", periods=2, freq="MS"))
+    res = cpu.seas_table(hist["A"], fwd)
+    assert res.loc["Dec", 2021] == 100 and res.loc["Jan", 2022] == 200
+
+    res = cpu.seas_table(hist)
+    assert res.shape == (2 * 19, 2)
+    assert res.loc[("B", "Q2"), 2021] == -5
+
+    # months missing inside a year take the previous month, those before/after the data stay empty
+    gappy = hist["A"][(hist.index.month != 5) & ((hist.index.year == 2021) | (hist.index.month > 2))]
+    res = cpu.seas_table(gappy)
+    assert res.loc["May", 2020] == 4 and res.loc["Q2", 2020] == 4.67
+    assert res.loc["May", 2021] == 4
+    assert np.isnan(res.loc["Jan", 2020]) and res.loc["Q1", 2020] == 3
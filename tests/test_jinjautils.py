@@ -1,7 +1,12 @@
 # python
+import asyncio
 import os
+import re
+
+import plotly as pl
 import plotly.express as px
 import plotly.graph_objects as go
+import pytest
 from commodplot import jinjautils
 
 def test_convert_dict_plotly_fig_html_div():
@@ -37,4 +42,124 @@ def test_render_html_to_file(tmp_path):
         package_loader_name="commodplot",
     )
 
-    assert test_out_loc.exists()
\ No newline at end of file
+    assert test_out_loc.exists()
+
+def test_plhtml_binary_encoding():
+    import numpy as np
+    import pandas as pd
+
+    x = pd.date_range("2020-01-01", periods=100)
+    fig = go.Figure([go.Scatter(x=x, y=np.arange(100.0) * i, name=str(i)) for i in range(3)])
+    data, layout, shared, refs = jinjautils.encode_figure_binary(fig.to_dict())
+    assert layout["xaxis"]["type"] == "date"
+    assert len(shared) == 1 and [(i, k) for i, k, _ in refs] == [(0, "x"), (1, "x"), (2, "x")]
+    assert all("x" not in trace for trace in data)
+
+    res = jinjautils.plhtml(fig, encoding="binary")
+    assert len(res) < len(jinjautils.plhtml(fig))
+    assert "Plotly.newPlot" in res
+
+
+def test_plhtml_lazy_render():
+    import json
+    import re
+
+    fig = go.Figure(data=[go.Bar(x=[1, 2, 3], y=[1, 3, 2])], layout=dict(height=300))
+    res = jinjautils.plhtml(fig, render="lazy")
+    assert 'class="plotly-lazy"' in res and "min-height:300px" in res
+    assert "Plotly.newPlot" not in res
+    payload = json.loads(re.search(r'type="application/json"[^>]*>(.*)</script>', res).group(1))
+    assert payload["data"][0]["type"] == "bar"
+    assert payload["config"] == jinjautils.plhtml_config
+
+
+def test_render_html_cached_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(jinjautils, "default_template_cache_dir", str(tmp_path / "bytecode"))
+    jinjautils.clear_environments()
+    template = tmp_path / "page.html"
+    template.write_text("{{ greeting }} {{ data.name }}")
+
+    assert jinjautils.render_html({"name": "a"}, str(template), template_globals={"greeting": "hi"}) == "hi a"
+    env = jinjautils.get_environment(template_dir=str(tmp_path))
+    compiled = env.get_template("page.html")
+    # same environment and compiled template, and globals don't carry over between renders
+    assert jinjautils.render_html({"name": "b"}, str(template)) == " b"
+    assert env.get_template("page.html") is compiled
+    assert os.listdir(tmp_path / "bytecode")
+
+    template.write_text("bye {{ data.name }}")
+    os.utime(template, (0, 0))  # mtime must differ from the compiled version
+    assert jinjautils.render_html({"name": "c"}, str(template)) == "bye c"
+    jinjautils.clear_environments()
+
+
+def test_environments_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(jinjautils, "max_environments", 2)
+    jinjautils.clear_environments()
+    envs = [jinjautils.get_environment(template_dir=str(tmp_path / str(i))) for i in range(3)]
+    assert len(jinjautils._environments) == 2
+    if "COMMODPLOT_TEMPLATE_CACHE" not in os.environ:
+        assert envs[0].bytecode_cache is None  # no disk cache unless asked for
+    assert jinjautils.get_environment(template_dir=str(tmp_path / "2")) is envs[2]
+    assert jinjautils.get_environment(template_dir=str(tmp_path / "0")) is not envs[0]
+    jinjautils.clear_environments()
+
+
+def test_stream_html(tmp_path):
+    fig = go.Figure(data=[go.Bar(x=[1, 2, 3], y=[1, 3, 2])])
+    data = {"name": "test", "fig1": fig, "figs": [fig]}
+
+    res = jinjautils.stream_html(
+        data, "test_report.html", str(tmp_path / "test.html"), package_loader_name="commodplot"
+    )
+    assert isinstance(data["figs"][0], jinjautils.LazyFigureHtml)
+    html = open(res, encoding="utf8").read()
+
+    expected = jinjautils.render_html({"name": "test", "fig1": fig}, "test_report.html", package_loader_name="commodplot")
+    # same page apart from the generated div ids and time
+    strip = lambda s: re.sub(r"[0-9a-f]{8}-[0-9a-f-]{27}|\d\d:\d\d", "", s)
+    assert strip(html) == strip(expected)
+
+
+def test_render_html_plotlyjs_bundle(tmp_path, monkeypatch):
+    bar = go.Figure(data=[go.Bar(x=[1, 2, 3], y=[1, 3, 2])])
+    candle = go.Figure(data=[go.Candlestick(x=[1], open=[1], high=[2], low=[0], close=[1])])
+    assert jinjautils.figure_trace_types({"a": bar, "b": [candle]}) == {"bar", "candlestick"}
+    assert jinjautils.plotlyjs_bundle({"bar", "scatter"}) == "basic"
+    assert jinjautils.plotlyjs_bundle({"bar", "candlestick"}) == "finance"
+    assert jinjautils.plotlyjs_bundle({"heatmap"}) == "cartesian"
+    assert jinjautils.plotlyjs_bundle({"scatter3d"}) is None
+
+    # full bundle unless asked to infer it, as charts may not all be figures in data
+    res = jinjautils.render_html({"name": "test", "fig1": bar}, "test_report.html", package_loader_name="commodplot")
+    assert "cdn.plot.ly/plotly-2.35.2.min.js" in res
+    res = jinjautils.render_html(
+        {"name": "test", "fig1": bar}, "test_report.html", package_loader_name="commodplot", infer_plotlyjs_bundle=True
+    )
+    assert "cdn.plot.ly/plotly-basic-2.35.2.min.js" in res
+    res = asyncio.run(
+        jinjautils.render_html_async(
+            {"name": "test", "fig1": bar}, "test_report.html", package_loader_name="commodplot", infer_plotlyjs_bundle=True
+        )
+    )
+    assert "cdn.plot.ly/plotly-basic-2.35.2.min.js" in res
+
+    # inline reads the pinned version from plotlyjs_dir, the smallest covering bundle first
+    (tmp_path / "plotly-finance-2.35.2.min.js").write_text("/* finance 2.35.2 */")
+    (tmp_path / "plotly-2.35.2.min.js").write_text("/* full 2.35.2 */")
+    monkeypatch.setattr(jinjautils, "plotlyjs_dir", str(tmp_path))
+    res = jinjautils.render_html(
+        {"name": "test", "fig1": bar}, "test_report.html", package_loader_name="commodplot",
+        plotlyjs="inline", infer_plotlyjs_bundle=True,
+    )
+    assert "/* finance 2.35.2 */" in res and "cdn.plot.ly/plotly-" not in res
+    res = jinjautils.render_html(
+        {"name": "test", "fig1": bar}, "test_report.html", package_loader_name="commodplot", plotlyjs="inline"
+    )
+    assert "/* full 2.35.2 */" in res
+
+    # never falls back to a plotly.js of another version
+    monkeypatch.setattr(jinjautils, "plotlyjs_dir", str(tmp_path / "missing"))
+    if pl.offline.get_plotlyjs_version() != jinjautils.plotlyjs_version:
+        with pytest.raises(FileNotFoundError):
+            jinjautils.plotlyjs_context(set(), "inline")
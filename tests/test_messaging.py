@@ -1,5 +1,9 @@
 # python
+import email
 import os
+import socketserver
+import threading
+
 import pytest
 import plotly.graph_objects as go
 from unittest.mock import patch
@@ -84,4 +88,149 @@ def test_compose_jinja_report(mock_smtp):
     sendmail_args = instance.sendmail.call_args[0]
     assert sendmail_args[0] == sender
     assert sendmail_args[1] == receiver
-    assert subject in sendmail_args[2]
\ No newline at end of file
+    assert subject in sendmail_args[2]
+
+@patch("commodplot.messaging.SMTP")
+def test_compose_jinja_report_cid_images(mock_smtp, monkeypatch):
+    from commodplot import commodplotimage
+
+    monkeypatch.setattr(
+        commodplotimage,
+        "to_images",
+        lambda figs, **kwargs: [b"\x89PNG\r\n\x1a\n%d" % (i % 2) for i in range(len(figs))],
+    )
+    instance = mock_smtp.return_value.__enter__.return_value
+    data = {"name": "test", "fig1": create_figure(), "figs": [create_figure(), create_figure()]}
+
+    messaging.compose_and_send_jinja_report(
+        subject="test_email",
+        data=data,
+        template="test_report.html",
+        package_loader_name="commodplot",
+        sender_email="sender@example.com",
+        receiver_email="receiver@example.com",
+        image_mode="cid",
+    )
+
+    message = instance.sendmail.call_args[0][2]
+    assert "data:image/png" not in message
+    assert message.count("Content-ID: <chart-") == 2  # 3 figures, 2 distinct images
+
+    # mixed -> related -> (html + images), so the images show inline in the body
+    parsed = email.message_from_string(message)
+    assert parsed.get_content_type() == "multipart/mixed"
+    (related,) = parsed.get_payload()
+    assert related.get_content_type() == "multipart/related"
+    assert [p.get_content_type() for p in related.get_payload()] == ["text/html", "image/png", "image/png"]
+
+
+class _SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal local SMTP server (no TLS) recording messages and connections"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=None):
+        self.messages, self.connections, self.drop_after = [], 0, drop_after
+        super().__init__(("127.0.0.1", 0), _SMTPStandInHandler)
+
+
+class _SMTPStandInHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        sent = 0
+        self.reply("220 localhost ready")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            cmd = line[:4].upper()
+            if not line or cmd == "QUIT":
+                self.reply("221 bye")
+                return
+            if cmd == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while (row := self.rfile.readline()) != b".\r\n":
+                    data.append(row)
+                self.server.messages.append(b"".join(data).decode())
+                self.reply("250 queued")
+                sent += 1
+                if self.server.drop_after and sent >= self.server.drop_after:
+                    return  # hang up without telling the client
+            elif cmd == "EHLO":
+                self.reply("250 localhost")
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp_server():
+    servers = []
+
+    def start(**kwargs):
+        server = _SMTPStandIn(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_smtp_sender_reuses_connections(smtp_server):
+    server = smtp_server()
+    messages = [
+        messaging.compose_report(f"report {i}", "<p>hi</p>", sender_email="a@example.com", receiver_email="b@example.com;c@example.com")
+        for i in range(10)
+    ]
+    with messaging.SMTPSender("127.0.0.1", server.server_address[1], starttls=False, connections=2) as sender:
+        assert sender.send_many(messages) == [None] * 10
+        messaging.compose_and_send_report("one more", "<p>hi</p>", sender_email="a@example.com", receiver_email="b@example.com", smtp=sender)
+    assert len(server.messages) == 11
+    assert server.connections <= 3  # 2 worker threads + the calling thread
+    assert sorted(m.split("Subject: ")[1].split("\r\n")[0] for m in server.messages[:10]) == sorted(f"report {i}" for i in range(10))
+
+
+def test_smtp_sender_reconnects(smtp_server):
+    server = smtp_server(drop_after=3)
+    message = messaging.compose_report("report", "<p>hi</p>", sender_email="a@example.com", receiver_email="b@example.com")
+    with messaging.SMTPSender("127.0.0.1", server.server_address[1], starttls=False) as sender:
+        assert sender.send_many([message] * 7) == [None] * 7
+    assert len(server.messages) == 7
+    assert server.connections == 3
+
+
+def test_compose_and_send_jinja_report_async(smtp_server, monkeypatch):
+    import asyncio
+    from commodplot import commodplotimage
+
+    async def to_images_async(figs, **kwargs):
+        return [b"\x89PNG\r\n\x1a\n%d" % i for i in range(len(figs))]
+
+    monkeypatch.setattr(commodplotimage, "to_images_async", to_images_async)
+    server = smtp_server()
+
+    async def main(sender):
+        await asyncio.gather(*[
+            messaging.compose_and_send_jinja_report_async(
+                subject=f"report {i}",
+                data={"name": "test", "fig1": create_figure()},
+                template="test_report.html",
+                package_loader_name="commodplot",
+                sender_email="a@example.com",
+                receiver_email="b@example.com",
+                image_mode="cid" if i % 2 else None,
+                smtp=sender,
+            )
+            for i in range(4)
+        ])
+
+    with messaging.SMTPSender("127.0.0.1", server.server_address[1], starttls=False, connections=2) as sender:
+        asyncio.run(main(sender))
+    assert len(server.messages) == 4
+    assert server.connections <= 2
+    assert sum("Content-ID: <chart-" in m for m in server.messages) == 2